@@ -0,0 +1,148 @@
+# drift_correction_async.py
+# asyncio drift correction loop: independent PV reads and writes run concurrently,
+# each with its own deadline, so a cycle waits for the slowest operation instead of the sum.
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from drift_correction_main import drift_correction, hutch_switcher, cycle_deadline_reached, \
+    hutch_selection_changed, CONFIG_DIR
+
+
+class async_drift_correction(drift_correction):
+    """drift correction with concurrent PV I/O on an asyncio event loop
+
+    Blocking backend calls run on a small thread pool; every call gets an
+    asyncio deadline on top of its CA timeout. Tracking and filter-state
+    puts of one batch stay in flight while the next batch is acquired.
+    """
+    def __init__(self, backend=None, config_dir=CONFIG_DIR, hutch_selector=None, workers=8):
+        super().__init__(backend, config_dir, hutch_selector)
+        self.executor = ThreadPoolExecutor(max_workers=workers, initializer=self.backend.attach_thread)
+        self.inflight = None  # puts of the previous batch
+        self.pulling = None  # pull_atm_values running on the pool
+
+    def close(self):
+        super().close()
+        self.executor.shutdown(wait=False)
+
+    async def call(self, fn, *args, deadline=1.0, **kw):
+        """runs a blocking backend call on the pool, raising TimeoutError after deadline (None: no deadline)"""
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(self.executor, partial(fn, *args, **kw)), deadline)
+
+    async def pull(self):
+        """runs pull_atm_values on the pool, one at a time
+
+        The pull has frame timeouts of its own and gets no asyncio deadline:
+        a wait that gave up would leave the thread draining the queue while
+        the next cycle starts a second consumer. A pull left running by a
+        cancelled cycle is waited for, and its frames dropped, before a new
+        one starts.
+        """
+        if self.pulling is not None:
+            try:
+                await self.pulling
+            except Exception:
+                pass
+        self.pulling = asyncio.get_running_loop().run_in_executor(self.executor, self.pull_atm_values)
+        await asyncio.shield(self.pulling)  # a cancelled cycle leaves the pull running, and tracked
+        self.pulling = None
+
+    def put_all(self, puts, deadline=1.0):
+        """concurrent puts of (pv, value) pairs"""
+        return asyncio.gather(*(self.call(pv.put, value=value, timeout=deadline, deadline=deadline)
+                                for pv, value in puts))
+
+    async def correct_async(self):
+        """filters data and applies correction, overlapping independent PV I/O"""
+        self.timer.start()
+        self.check_hutch()
+        # the ATM FB read runs alongside the fill and is only needed for the correction
+        atm_fb = asyncio.ensure_future(self.call(self.atm_fb_pv.get, timeout=60.0, deadline=60.0))
+        try:
+            await self.fill_async()
+            if not self.average():
+                return
+            self.timer.lap('average')
+            self.atm_fb = await atm_fb
+            self.timer.lap('actuate')
+        finally:
+            if not atm_fb.done():  # the cycle ended without a correction
+                atm_fb.cancel()
+        applied = self.compute_correction()
+        puts = self.publish_puts()
+        if applied:
+            puts.append((self.atm_fb_pv, self.atm_fb))
+        if self.inflight is not None:
+            puts_done, self.inflight = self.inflight, None
+            await asyncio.gather(puts_done, self.put_all(puts))
+        else:
+            await self.put_all(puts)
+        if applied:
+            self.applied_stamp = self.clock()
+        self.timer.lap('publish')
+        # recorder, metrics and auto-limit puts on the pool; no deadline, they finish before the next cycle
+        await self.call(self.end_cycle, applied, deadline=None)
+
+    async def fill_async(self):
+        """fills the sample buffer, the puts of each batch in flight while the next is acquired"""
+        self.start_fill()
+        self.timer.lap('filter')
+        while not self.fill_from_pending():
+            self.timer.lap('average')
+            try:
+                await self.pull()
+            except cycle_deadline_reached:
+                self.partial_fill()  # correct from the partial buffer or re-raise
+                break
+            self.timer.lap('acquire')
+            # hand the tracking puts to the pool before filtering, which runs on this thread
+            tracking = self.put_all(self.tracking_puts())
+            await asyncio.sleep(0)  # lets the put tasks start
+            self.filter_batch()
+            if self.inflight is not None:  # at most one earlier batch of puts outstanding
+                await self.inflight
+            self.inflight = asyncio.gather(tracking, self.put_all(self.filter_puts()))
+            self.timer.lap('filter')
+
+
+async def run_async(backend=None, config_dir=CONFIG_DIR, hot_switch=False):
+    print(f"Drift correction script (asyncio) started at {time.strftime('%Y-%m-%d %H:%M:%S')}")
+    switcher = None
+    if hot_switch:  # both hutches connected, switched in memory
+        switcher = hutch_switcher(backend, config_dir, async_drift_correction)
+        correction = switcher.active
+    else:
+        correction = async_drift_correction(backend, config_dir)  # initialize
+    heartbeat_counter = 0
+    try:
+        while True:
+            try:
+                # heartbeat put runs alongside the correction cycle
+                heartbeat_counter += 1
+                await asyncio.gather(
+                    correction.call(correction.heartbeat_pv.put, value=heartbeat_counter, timeout=1.0),
+                    correction.correct_async())
+                await asyncio.sleep(correction.cycle_sleep)
+            except cycle_deadline_reached:
+                await correction.call(correction.end_deadline_cycle, deadline=None)
+            except hutch_selection_changed:
+                print("[INFO] Hutch selection changed.")
+                correction.inflight = None
+                if switcher is not None:
+                    correction = switcher.switch()
+                else:
+                    correction.close()
+                    correction = async_drift_correction(backend, config_dir)  # re-initialize
+                await correction.call(correction.atm_fb_pv.put, value=0, timeout=1.0)
+            except asyncio.TimeoutError:
+                print("[ERROR] PV operation missed its deadline.")
+                correction.inflight = None
+                await asyncio.sleep(1.0)
+            except Exception as e:
+                print(f"[ERROR] Unexpected error: {e}")
+                correction.inflight = None
+                await asyncio.sleep(1.0)  # Prevent rapid error loops
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        print("Script terminated by user.")
@@ -0,0 +1,111 @@
+# drift_correction_bench.py
+# Benchmarks the feedback loop against the simulated PV backend.
+# usage: python drift_correction_bench.py [--modes 1 2 3 4 5 6] [--sizes 10 100 1000] [--output bench_results.json]
+import argparse
+import json
+import os
+import time
+import tracemalloc
+import numpy as np
+from drift_correction_main import drift_correction, sim_backend_for, cycle_deadline_reached
+
+CONFIG_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def bench_case(avg_mode, sample_size, args):
+    """runs the loop for one avg_mode and sample size, returns its figures"""
+    backend = sim_backend_for(CONFIG_DIR, ttall_rate=args.rate, latency=args.latency, jitter=args.jitter)
+    correction = drift_correction(backend, CONFIG_DIR)
+    backend.write(correction.avg_mode_pv.name, avg_mode)
+    backend.write(correction.sample_size_pv.name, sample_size)
+    for i in range(args.warmup):
+        try:
+            correction.correct()
+        except cycle_deadline_reached:
+            correction.end_deadline_cycle()
+    # measured section starts from clean counters
+    backend.ops.clear()
+    monitor = correction.ttall_monitor
+    queue = monitor.queue if monitor else None
+    received, dropped, overflows = (queue.received, queue.dropped, queue.overflows) if queue is not None else (0, 0, 0)
+    frames, accepted, partial = correction.frame_count, correction.accept_count, correction.partial_count
+    if args.memory:
+        tracemalloc.start()
+    latencies = []
+    timeouts = 0
+    heartbeat = 0
+    start = time.perf_counter()
+    while (len(latencies) < args.cycles) and (time.perf_counter() - start < args.duration):
+        t0 = time.perf_counter()
+        try:  # one run() iteration without the fixed sleep
+            heartbeat += 1
+            correction.heartbeat_pv.put(value=heartbeat, timeout=1.0)
+            correction.correct()
+        except cycle_deadline_reached:
+            timeouts += 1
+            correction.end_deadline_cycle()
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    peak_kb = None
+    if args.memory:
+        peak_kb = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    correction.close()
+    backend.stop()
+    accepted = correction.accept_count - accepted
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'avg_mode': avg_mode,
+        'sample_size': sample_size,
+        'cycles': len(latencies),
+        'fill_timeouts': timeouts,
+        'partial_corrections': correction.partial_count - partial,
+        'elapsed_s': elapsed,
+        'corrections_per_s': (len(latencies) - timeouts) / elapsed,
+        'latency_p50_ms': float(np.percentile(latencies_ms, 50)),
+        'latency_p99_ms': float(np.percentile(latencies_ms, 99)),
+        'latency_max_ms': float(latencies_ms.max()),
+        'frames_received': (queue.received - received) if queue is not None else None,
+        'frames_dropped': (queue.dropped - dropped) if queue is not None else None,
+        'queue_overflows': (queue.overflows - overflows) if queue is not None else None,
+        'queue_high_water': queue.high_water if queue is not None else None,
+        'frames_filtered': correction.frame_count - frames,
+        'samples_accepted': accepted,
+        'ca_gets': backend.ops['get'],
+        'ca_puts': backend.ops['put'],
+        'gets_per_accepted': backend.ops['get'] / accepted if accepted else None,
+        'puts_per_accepted': backend.ops['put'] / accepted if accepted else None,
+        'peak_memory_kb': peak_kb,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drift correction loop benchmark (simulated PVs)')
+    parser.add_argument('--modes', type=int, nargs='+', default=[1, 2, 3, 4, 5, 6], help='avg_mode values')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='sample sizes')
+    parser.add_argument('--cycles', type=int, default=200, help='max measured cycles per case')
+    parser.add_argument('--duration', type=float, default=5.0, help='max measured seconds per case')
+    parser.add_argument('--warmup', type=int, default=2, help='unmeasured cycles per case')
+    parser.add_argument('--rate', type=float, default=1000.0, help='simulated TTALL rate (Hz)')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated CA latency per op (s)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='simulated CA latency jitter (s)')
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help='skip tracemalloc')
+    parser.add_argument('--output', default='bench_results.json', help='JSON results file')
+    args = parser.parse_args()
+
+    results = []
+    for avg_mode in args.modes:
+        for sample_size in args.sizes:
+            result = bench_case(avg_mode, sample_size, args)
+            results.append(result)
+            print(f"mode {avg_mode} size {sample_size:5d}: {result['corrections_per_s']:8.2f} corr/s, "
+                  f"p50 {result['latency_p50_ms']:8.2f} ms, p99 {result['latency_p99_ms']:8.2f} ms, "
+                  f"gets/sample {result['gets_per_accepted']}, dropped {result['frames_dropped']}")
+    with open(args.output, 'w') as file:
+        json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'settings': vars(args), 'results': results},
+                  file, indent=4)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
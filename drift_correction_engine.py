@@ -0,0 +1,128 @@
+# drift_correction_engine.py
+# Runs one independent feedback channel per hutch config in a single process.
+# usage: python drift_correction_engine.py crixs_atm_fb.json qrixs_atm_fb.json [--sim]
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from drift_correction_main import drift_correction, cycle_deadline_reached, sim_seed, CONFIG_DIR, HUTCH_SELECTOR_PV
+from drift_correction_pv import psp_backend, sim_backend
+
+# per-channel output PVs that two channels must not share
+CHANNEL_PVS = ('atm_fb_pv', 'heartbeat_pv')
+
+
+def channel_name(config_file):
+    """channel name of a config file, its base name without extension"""
+    return os.path.splitext(os.path.basename(config_file))[0]
+
+
+def sim_overrides(config_path, name):
+    """simulated output PVs of its own for a channel whose config leaves them empty"""
+    with open(config_path, 'r') as file:
+        hutch_config = json.load(file)
+    return {attr: f"SIM:{name.upper()}:{attr[:-3].upper()}" for attr in CHANNEL_PVS if not hutch_config.get(attr)}
+
+
+class feedback_engine():
+    """one drift_correction channel per config, all on one backend
+
+    Channels share the backend (one CA context) and a thread pool with one
+    loop thread per channel. Each channel follows its own config only: its
+    heartbeat_pv, on_off_pv and atm_fb_pv come from the config and the
+    hutch selector is ignored.
+    """
+    def __init__(self, config_files, backend=None, config_dir=CONFIG_DIR, overrides=None):
+        self.backend = psp_backend() if backend is None else backend
+        self.channels = {}
+        for config_file in config_files:
+            name = channel_name(config_file)
+            self.channels[name] = drift_correction(self.backend, config_dir, config_file=config_file,
+                                                   overrides=(overrides or {}).get(name))
+        try:
+            self.check_channels()
+        except ValueError:
+            for correction in self.channels.values():
+                correction.close()
+            raise
+        self.stop_event = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=len(self.channels), thread_name_prefix='feedback',
+                                           initializer=self.backend.attach_thread)
+
+    def check_channels(self):
+        """raises ValueError when two channels would write the same output PV"""
+        for attr in ('atm_fb_pv', 'heartbeat_pv', 'on_off_pv'):
+            owners = {}
+            for name, correction in self.channels.items():
+                owners.setdefault(getattr(correction, attr).name, []).append(name)
+            for pv_name, names in owners.items():
+                if len(names) < 2:
+                    continue
+                if attr in CHANNEL_PVS:
+                    raise ValueError(f"channels {', '.join(names)} share {attr} {pv_name}; "
+                                     f"set {attr} in each config")
+                print(f"[INFO] channels {', '.join(names)} share {attr} {pv_name}")
+
+    def run_channel(self, name, correction):
+        """feedback loop of one channel, until stop()"""
+        heartbeat_counter = 0
+        while not self.stop_event.is_set():
+            try:
+                heartbeat_counter += 1
+                correction.heartbeat_pv.put(value=heartbeat_counter, timeout=1.0)
+                correction.correct()
+                self.stop_event.wait(correction.cycle_sleep)
+            except cycle_deadline_reached:
+                correction.end_deadline_cycle()
+            except Exception as e:
+                print(f"[ERROR] {name}: unexpected error: {e}")
+                self.stop_event.wait(1.0)  # Prevent rapid error loops
+
+    def run(self):
+        """runs every channel until stop() or KeyboardInterrupt"""
+        futures = [self.executor.submit(self.run_channel, name, correction)
+                   for name, correction in self.channels.items()]
+        try:
+            while not self.stop_event.wait(1.0):
+                for future in futures:
+                    if future.done():
+                        future.result()  # re-raises a loop that died
+        finally:
+            self.stop()
+
+    def stop(self):
+        """ends the channel loops and stops their PV monitors"""
+        self.stop_event.set()
+        self.executor.shutdown(wait=True)
+        for correction in self.channels.values():
+            correction.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drift correction for several hutches in one process')
+    parser.add_argument('configs', nargs='+', help='hutch config files, one feedback channel each')
+    parser.add_argument('--config-dir', default=CONFIG_DIR, help='directory of the config files')
+    parser.add_argument('--sim', action='store_true', help='simulated PVs with a closed-loop timetool per channel')
+    args = parser.parse_args()
+
+    backend = None
+    overrides = {}
+    if args.sim:  # each channel gets simulated hook and heartbeat PVs unless its config names them
+        backend = sim_backend({HUTCH_SELECTOR_PV: 0})
+        for config_file in args.configs:
+            config_path = os.path.join(args.config_dir, config_file)
+            name = channel_name(config_file)
+            overrides[name] = sim_overrides(config_path, name)
+            sim_seed(backend, config_path, overrides=overrides[name])
+    print(f"Drift correction engine started at {time.strftime('%Y-%m-%d %H:%M:%S')}")
+    engine = feedback_engine(args.configs, backend, args.config_dir, overrides)
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        print("Script terminated by user.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# drift_correction_filter.py
+import time
+import numpy as np
+from drift_correction_stats import quantile_sketch
+
+# filter_state codes; code n is bit (n - 1) of the filter mask
+AMPL_LOW = 1  # amplitude too low
+AMPL_HIGH = 2  # amplitude too high
+FWHM_LOW = 3  # FWHM too low
+FWHM_HIGH = 4  # FWHM too high
+POS_LOW = 5  # position too low
+POS_HIGH = 6  # position too high
+POS_SAME = 7  # position the same (unused)
+TXT_MOVING = 8  # txt stage is moving
+FILTER_CODES = (AMPL_LOW, AMPL_HIGH, FWHM_LOW, FWHM_HIGH, POS_LOW, POS_HIGH, TXT_MOVING)
+REASON_NAMES = {AMPL_LOW: 'ampl_low', AMPL_HIGH: 'ampl_high', FWHM_LOW: 'fwhm_low', FWHM_HIGH: 'fwhm_high',
+                POS_LOW: 'pos_low', POS_HIGH: 'pos_high', TXT_MOVING: 'txt_moving'}
+
+
+def reason_bit(code):
+    """filter mask bit for a filter_state code"""
+    return 1 << (code - 1)
+
+
+def filter_state(mask):
+    """legacy single filter_state code for a mask, highest reason wins"""
+    return int(mask).bit_length()
+
+
+def filter_frames(ampl, fwhm, pos_fs, limits, txt_moving=False):
+    """evaluates all filter conditions over a batch of frames in one pass
+
+    ampl, fwhm and pos_fs are 1-D arrays with one entry per frame, pos_fs
+    already offset-adjusted. txt_moving is a bool or a per-frame bool array.
+    Returns the per-frame mask of failed conditions; a frame is accepted
+    when its mask is 0. NaNs fail every comparison, as in the scalar filter.
+    """
+    mask = np.zeros(len(ampl), dtype=np.uint16)
+    mask |= ~(ampl > limits['ampl_min']) * np.uint16(reason_bit(AMPL_LOW))
+    mask |= ~(ampl < limits['ampl_max']) * np.uint16(reason_bit(AMPL_HIGH))
+    mask |= ~(fwhm > limits['fwhm_min']) * np.uint16(reason_bit(FWHM_LOW))
+    mask |= ~(fwhm < limits['fwhm_max']) * np.uint16(reason_bit(FWHM_HIGH))
+    mask |= ~(pos_fs > limits['pos_fs_min']) * np.uint16(reason_bit(POS_LOW))
+    mask |= ~(pos_fs < limits['pos_fs_max']) * np.uint16(reason_bit(POS_HIGH))
+    mask |= np.asarray(txt_moving, dtype=bool) * np.uint16(reason_bit(TXT_MOVING))
+    return mask
+
+
+# columns of rejection_window counts and of its waveform after the acceptance rate
+WINDOW_COLUMNS = ('frames', 'accepted') + tuple(REASON_NAMES[code] for code in FILTER_CODES)
+
+
+class rejection_window():
+    """per-reason rejection counts over a sliding time window
+
+    Counts go into a ring of time buckets; running totals are kept next to
+    it, so adding a batch costs O(1) per frame and reading the window is
+    O(1). A frame failing several conditions counts under each reason.
+    """
+    def __init__(self, window=10.0, buckets=10):
+        self.bucket_s = window / buckets
+        self.buckets = np.zeros((buckets, len(WINDOW_COLUMNS)), dtype=np.int64)
+        self.totals = np.zeros(len(WINDOW_COLUMNS), dtype=np.int64)
+        self.epoch = None  # bucket number of the newest bucket
+        self.bits = np.array([reason_bit(code) for code in FILTER_CODES], dtype=np.uint16)
+
+    def advance(self, now):
+        """expires buckets older than the window"""
+        epoch = int(now // self.bucket_s)
+        if self.epoch is None:
+            self.epoch = epoch
+        for stale in range(self.epoch + 1, min(epoch, self.epoch + len(self.buckets)) + 1):
+            row = self.buckets[stale % len(self.buckets)]
+            self.totals -= row
+            row[:] = 0
+        self.epoch = max(self.epoch, epoch)
+
+    def add(self, masks, now=None):
+        """counts a batch of filter masks"""
+        self.advance(time.monotonic() if now is None else now)
+        masks = np.asarray(masks, dtype=np.uint16)
+        row = np.empty(len(WINDOW_COLUMNS), dtype=np.int64)
+        row[0] = len(masks)
+        row[1] = np.count_nonzero(masks == 0)
+        row[2:] = np.count_nonzero(masks[:, None] & self.bits, axis=0)
+        self.buckets[self.epoch % len(self.buckets)] += row
+        self.totals += row
+
+    def acceptance(self):
+        """accepted fraction of the frames in the window, nan without frames"""
+        return float(self.totals[1] / self.totals[0]) if self.totals[0] else float('nan')
+
+    def waveform(self, now=None):
+        """acceptance rate followed by the window counts in WINDOW_COLUMNS order"""
+        self.advance(time.monotonic() if now is None else now)
+        return [self.acceptance()] + [int(count) for count in self.totals]
+
+
+# sketched quantity -> (low, high) filter limits it sets
+TUNED_LIMITS = {'ampl': ('ampl_min', 'ampl_max'), 'fwhm': ('fwhm_min', 'fwhm_max'),
+                'pos_fs': ('pos_fs_min', 'pos_fs_max')}
+# sketched quantity -> mask bits of the other two quantities
+OTHER_BITS = {
+    'ampl': reason_bit(FWHM_LOW) | reason_bit(FWHM_HIGH) | reason_bit(POS_LOW) | reason_bit(POS_HIGH),
+    'fwhm': reason_bit(AMPL_LOW) | reason_bit(AMPL_HIGH) | reason_bit(POS_LOW) | reason_bit(POS_HIGH),
+    'pos_fs': reason_bit(AMPL_LOW) | reason_bit(AMPL_HIGH) | reason_bit(FWHM_LOW) | reason_bit(FWHM_HIGH),
+}
+
+
+class limit_tuner():
+    """filter limits proposed from rolling amplitude, FWHM and position quantiles
+
+    Each quantity has two quantile sketches per time bucket and running
+    totals over the window, like rejection_window: one of all frames and
+    one of the frames that pass the current limits of the other two
+    quantities. A frame failing those is known bad and never shapes the
+    limits; its share of the window is counted.
+
+    A limit pair is proposed as the median of the learning set plus or
+    minus width robust standard deviations (interquartile range / 1.349);
+    amplitude and FWHM limits stay at or above 0. Each limit then moves by
+    at most step times the current limit span per proposal, and a limit
+    is only loosened as far as the all-frames quantile at the known-bad
+    share, so the filter keeps rejecting at least that share of frames on
+    each side it opens.
+    """
+    def __init__(self, window=60.0, buckets=6, width=5.0, step=0.25, min_count=200):
+        self.bucket_s = window / buckets
+        self.buckets = [self.new_bucket() for i in range(buckets)]
+        self.totals = self.new_bucket()
+        self.epoch = None  # bucket number of the newest bucket
+        self.width = width
+        self.step = step
+        self.min_count = min_count  # learning samples in the window before a quantity gets limits
+
+    def new_bucket(self):
+        """learning and all-frames sketches and counts (frames, known bad per quantity)"""
+        return {'learn': {name: quantile_sketch() for name in TUNED_LIMITS},
+                'all': {name: quantile_sketch() for name in TUNED_LIMITS},
+                'counts': np.zeros(1 + len(TUNED_LIMITS), dtype=np.int64)}
+
+    def advance(self, now):
+        """expires buckets older than the window"""
+        epoch = int(now // self.bucket_s)
+        if self.epoch is None:
+            self.epoch = epoch
+        for stale in range(self.epoch + 1, min(epoch, self.epoch + len(self.buckets)) + 1):
+            bucket = self.buckets[stale % len(self.buckets)]
+            for kind in ('learn', 'all'):
+                for name, sketch in bucket[kind].items():
+                    self.totals[kind][name].merge(sketch, -1)
+                    sketch.clear()
+            self.totals['counts'] -= bucket['counts']
+            bucket['counts'][:] = 0
+        self.epoch = max(self.epoch, epoch)
+
+    def add(self, ampl, fwhm, pos_fs, masks, now=None):
+        """adds frames taken while TXT is still, with their filter masks"""
+        self.advance(time.monotonic() if now is None else now)
+        bucket = self.buckets[self.epoch % len(self.buckets)]
+        masks = np.asarray(masks, dtype=np.uint16)
+        counts = np.empty(1 + len(TUNED_LIMITS), dtype=np.int64)
+        counts[0] = len(masks)
+        for i, (name, values) in enumerate((('ampl', ampl), ('fwhm', fwhm), ('pos_fs', pos_fs))):
+            known_bad = (masks & OTHER_BITS[name]) != 0
+            counts[1 + i] = np.count_nonzero(known_bad)
+            for kind, samples in (('learn', values[~known_bad]), ('all', values)):
+                bucket[kind][name].add(samples)
+                self.totals[kind][name].add(samples)
+        bucket['counts'] += counts
+        self.totals['counts'] += counts
+
+    def limits(self, current, now=None):
+        """proposed limits by name from the current ones, for the quantities with enough learning samples"""
+        self.advance(time.monotonic() if now is None else now)
+        frames = self.totals['counts'][0]
+        limits = {}
+        for i, (name, (low_name, high_name)) in enumerate(TUNED_LIMITS.items()):
+            learn, every = self.totals['learn'][name], self.totals['all'][name]
+            if len(learn) < self.min_count:
+                continue
+            centre = learn.quantile(0.5)
+            sigma = (learn.quantile(0.75) - learn.quantile(0.25)) / 1.349
+            low, high = centre - self.width * sigma, centre + self.width * sigma
+            if name != 'pos_fs':
+                low = max(low, 0.0)
+            cur_low, cur_high = current[low_name], current[high_name]
+            max_step = self.step * (cur_high - cur_low)
+            low = min(max(low, cur_low - max_step), cur_low + max_step)
+            high = min(max(high, cur_high - max_step), cur_high + max_step)
+            bad = self.totals['counts'][1 + i] / frames
+            if (low < cur_low):  # never opens up below the known-bad share
+                low = max(low, min(cur_low, every.quantile(bad)))
+            if (high > cur_high):
+                high = min(high, max(cur_high, every.quantile(1.0 - bad)))
+            if (low < high):
+                limits[low_name], limits[high_name] = low, high
+        return limits
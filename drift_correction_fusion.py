@@ -0,0 +1,149 @@
+# drift_correction_fusion.py
+# TTALL source layouts and inverse-variance fusion of measurements from several timetools.
+import numpy as np
+
+# TTALL index of each quantity, standard layout
+DEFAULT_FIELDS = {'pos_ps': 1, 'ampl': 2, 'fwhm': 5}
+
+
+class ttall_source():
+    """one timetool TTALL PV with its field layout and a running noise estimate
+
+    fields maps pos_ps, ampl and fwhm to TTALL indices. pos_offset (fs) is
+    this camera's zero relative to the primary timetool and is subtracted
+    on top of the pos_offset PV. limits overrides single filter limits for
+    this camera (e.g. an amplitude scale of its own); the rest follow the
+    limit PVs.
+
+    The per-shot variance is estimated from half the squared difference of
+    consecutive accepted positions, with exponential forgetting, so slow
+    drift hardly enters it. Running means of the accepted amplitude and
+    FWHM (levels) put this camera's values on another camera's scale.
+    """
+    def __init__(self, name, pv, fields=None, pos_offset=0.0, limits=None, memory=0.01):
+        self.name = name
+        self.pv = pv
+        self.fields = dict(DEFAULT_FIELDS, **(fields or {}))
+        self.pos_offset = float(pos_offset)
+        self.limits = dict(limits or {})
+        self.memory = memory
+        self.monitor = None  # ttall_monitor in monitor mode
+        self.poll = None  # get in flight in poll mode
+        self.responsive = True  # answered the last poll in time
+        self.levels = None  # running means of accepted (ampl, fwhm)
+        self.level_count = 0
+        self.held = None  # accepted (stamps, ampl, fwhm, pos_fs) waiting for the other sources
+        self.last_pos = None  # newest accepted position (fs)
+        self.variance = None  # per-shot variance estimate (fs^2)
+        self.diffs = 0  # differences taken into variance
+        self.accepted = 0  # accepted frames in total
+
+    def columns(self, frames):
+        """(pos_ps, ampl, fwhm) columns of an (N, k) array of TTALL frames"""
+        return tuple(frames[:, self.fields[name]] for name in ('pos_ps', 'ampl', 'fwhm'))
+
+    def source_limits(self, limits):
+        """the filter limits for this camera"""
+        return dict(limits, **self.limits) if self.limits else limits
+
+    def update_noise(self, pos_fs):
+        """updates the variance estimate with accepted positions, oldest first"""
+        if len(pos_fs) == 0:
+            return
+        self.accepted += len(pos_fs)
+        values = np.concatenate(([self.last_pos], pos_fs)) if (self.last_pos is not None) else pos_fs
+        for half_square in (0.5 * np.diff(values) ** 2).tolist():
+            self.diffs += 1
+            weight = max(1.0 / self.diffs, self.memory)
+            self.variance = half_square if (self.variance is None) else \
+                self.variance + weight * (half_square - self.variance)
+        self.last_pos = float(pos_fs[-1])
+
+    def set_responsive(self, responsive, reason=''):
+        """records whether the last poll answered in time, printing only the changes"""
+        if responsive and not self.responsive:
+            print(f"[INFO] TTALL source {self.name} answers again")
+        elif self.responsive and not responsive:
+            print(f"[ERROR] TTALL source {self.name} skipped until it answers: {reason}")
+        self.responsive = responsive
+
+    def update_levels(self, ampl, fwhm):
+        """updates the running means of accepted amplitude and FWHM"""
+        for values in zip(ampl.tolist(), fwhm.tolist()):
+            self.level_count += 1
+            weight = max(1.0 / self.level_count, self.memory)
+            self.levels = values if (self.levels is None) else \
+                tuple(level + weight * (value - level) for level, value in zip(self.levels, values))
+
+    def scaled(self, ampl, fwhm, reference):
+        """ampl and fwhm on the scale of the reference source, unchanged while either has no levels"""
+        if (reference is self) or (reference.levels is None) or (self.levels is None) or (0.0 in self.levels):
+            return ampl, fwhm
+        return ampl * (reference.levels[0] / self.levels[0]), fwhm * (reference.levels[1] / self.levels[1])
+
+    def reset(self):
+        self.last_pos = None
+        self.variance = None
+        self.diffs = 0
+        self.levels = None
+        self.level_count = 0
+        self.held = None
+
+
+def shot_index(stamps, origin, tolerance):
+    """shot number of each sample in stamp order: a gap over tolerance or a repeated source starts a new shot"""
+    shot = np.zeros(len(stamps), dtype=int)
+    current, seen, previous = 0, set(), None
+    for i, (stamp, source) in enumerate(zip(stamps.tolist(), origin.tolist())):
+        if (previous is not None) and ((stamp - previous > tolerance) or (source in seen)):
+            current += 1
+            seen = set()
+        seen.add(source)
+        shot[i] = current
+        previous = stamp
+    return shot
+
+
+def fuse(batches, tolerance=0.004, now=None):
+    """combines accepted samples of several sources into one sample per shot
+
+    batches holds one (stamps, ampl, fwhm, pos_fs, variance) tuple per
+    source, ampl and fwhm on a common scale. Samples whose stamps lie
+    within tolerance of the previous one (across sources) form one shot,
+    a second sample of a source starting the next one, and each quantity
+    is averaged over the shot with weights 1 / variance;
+    a source without an estimate yet counts with the mean of the known
+    variances. A shot seen by one source passes unchanged.
+
+    With now given, a shot missing a source whose newest sample is later
+    than now - tolerance is held back, with every shot after it, as the
+    missing frames may still arrive. Returns (stamps, ampl, fwhm, pos_fs,
+    sources, held): the fused shots with the number of samples in each,
+    and per batch the (stamps, ampl, fwhm, pos_fs) it holds back, to be
+    put in front of that source's next batch.
+    """
+    known = [variance for *columns, variance in batches if (variance is not None) and (variance > 0)]
+    default = float(np.mean(known)) if known else 1.0
+    stamps = np.concatenate([batch[0] for batch in batches])
+    values = np.column_stack([np.concatenate([batch[i] for batch in batches]) for i in (1, 2, 3)])
+    weights = np.concatenate([np.full(len(batch[0]), 1.0 / (batch[4] if batch[4] else default))
+                              for batch in batches])
+    origin = np.concatenate([np.full(len(batch[0]), index) for index, batch in enumerate(batches)])
+    order = np.argsort(stamps, kind='stable')
+    stamps, values, weights, origin = stamps[order], values[order], weights[order], origin[order]
+    shot = shot_index(stamps, origin, tolerance)
+    n_shots = int(shot[-1]) + 1 if len(shot) else 0
+    last = np.flatnonzero(np.diff(np.concatenate((shot, [n_shots]))))  # newest sample of each shot
+    if (now is not None) and n_shots:
+        seen = np.zeros((n_shots, len(batches)), dtype=bool)
+        seen[shot, origin] = True
+        waiting = ~seen.all(axis=1) & (stamps[last] > now - tolerance)
+        if waiting.any():
+            n_shots = int(np.argmax(waiting))  # the first shot held back
+    done = shot < n_shots
+    held = [tuple(column[~done & (origin == index)] for column in (stamps, *values.T))
+            for index in range(len(batches))]
+    shot, stamps, values, weights, last = shot[done], stamps[done], values[done], weights[done], last[:n_shots]
+    total = np.bincount(shot, weights=weights, minlength=n_shots)
+    fused = [np.bincount(shot, weights=weights * values[:, i], minlength=n_shots) / total for i in range(3)]
+    return stamps[last], fused[0], fused[1], fused[2], np.bincount(shot, minlength=n_shots), held
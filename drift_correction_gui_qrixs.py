@@ -268,7 +268,7 @@ class DriftCorrectionDisplay(Display):
         avg_group = QGroupBox("Averaging Controls")
         avg_layout = QGridLayout(avg_group)
         # Average mode
-        avg_layout.addWidget(QLabel("Avg Mode (1=Block, 2=Moving, 3=Decay):"), 0, 0)
+        avg_layout.addWidget(QLabel("Avg Mode (1=Block, 2=Moving, 3=Decay, 4=Kalman, 5=Median, 6=Gated):"), 0, 0)
         avg_mode_edit = self.create_integer_lineedit("ca://LAS:UNDS:FLOAT:24")
         avg_layout.addWidget(avg_mode_edit, 0, 1)
         avg_layout.addWidget(QLabel("Current:"), 0, 2)
@@ -1,13 +1,57 @@
 # drift_correction_main.py
+import os
+import sys
 import time
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 import numpy as np
 import json
-from psp.Pv import Pv
+from drift_correction_pv import frame_timeout, wait_any, ttall_monitor, param_cache, motion_tracker, psp_backend, sim_backend, sim_timetool
+from drift_correction_stats import ring_buffer, decaying_median, drift_kalman, p2_quantile, hampel_gate, allan_deviation
+from drift_correction_filter import filter_frames, filter_state, rejection_window, limit_tuner, WINDOW_COLUMNS
+from drift_correction_metrics import PHASES, phase_timer, write_metrics_file
+from drift_correction_recorder import frame_recorder, record_prefix
+from drift_correction_spectrum import spectrum_worker
+from drift_correction_fusion import ttall_source, fuse
 
+FILTER_LIMITS = ('ampl_min', 'ampl_max', 'fwhm_min', 'fwhm_max', 'pos_fs_min', 'pos_fs_max')
+LIMIT_PARAMS = FILTER_LIMITS + ('pos_offset',)
 
-class buffer_fill_timeout(Exception):
-    """Raised when error buffer never fills within allowed iterations."""
+CONFIG_DIR = '/cds/group/laser/timing/lcls-drift-corr'
+HUTCH_SELECTOR_PV = 'LAS:UNDS:FLOAT:40'
+HEARTBEAT_PV = 'LAS:UNDS:FLOAT:41'
+ON_OFF_PV = 'LAS:UNDS:FLOAT:67'
+ATM_FB_PV = 'LAS:LHN:LLG2:02:PHASCTL:ATM_FBK_OFFSET'
+
+# spectrum_worker result -> optional waveform PV config key
+SPECTRUM_PVS = {
+    'freq': 'spectrum_freq_pv',
+    'error_psd': 'spectrum_error_pv',
+    'correction_psd': 'spectrum_correction_pv',
+    'transfer': 'spectrum_transfer_pv',
+    'suppression': 'spectrum_suppression_pv',
+}
+
+# settings seeded into the simulated backend, by config key
+SIM_DEFAULTS = {
+    'ampl_min_pv': 0.01,
+    'ampl_max_pv': 1.0,
+    'fwhm_min_pv': 20.0,
+    'fwhm_max_pv': 500.0,
+    'pos_fs_min_pv': -2000.0,
+    'pos_fs_max_pv': 2000.0,
+    'pos_offset_pv': 0.0,
+    'txt_pv': 0.0,
+    'avg_mode_pv': 1,
+    'decay_factor_pv': 0.95,
+    'fb_direction_pv': 1,
+    'fb_gain_pv': 0.5,
+    'sample_size_pv': 50,
+}
+
+
+class cycle_deadline_reached(Exception):
+    """Raised when the fill deadline passes with too few samples for a correction."""
     pass
 
 
@@ -18,23 +62,35 @@ class hutch_selection_changed(Exception):
 
 class drift_correction():
     """main class for drift correction"""
-    def __init__(self):
-        # Load hutch config file
-        self.hutch_selector_pv = Pv('LAS:UNDS:FLOAT:40')
-        self.hutch_selector = self.hutch_selector_pv.get(timeout=1.0)
+    def __init__(self, backend=None, config_dir=CONFIG_DIR, hutch_selector=None, config_file=None, overrides=None):
+        init_start = time.perf_counter()
+        # PV backend, psp Channel Access unless a simulated one is passed in
+        self.backend = psp_backend() if backend is None else backend
+        Pv = self.backend.pv
+        # Load hutch config file, for the selected hutch unless one is given
+        self.hutch_selector_pv = Pv(HUTCH_SELECTOR_PV)
+        # a fixed config file ignores the hutch selector (multi-hutch engine)
+        self.follow_selector = config_file is None
+        if self.follow_selector and (hutch_selector is None):
+            hutch_selector = self.hutch_selector_pv.get(timeout=1.0)
+        self.hutch_selector = hutch_selector
         print(f"Initializing with hutch_selector: {self.hutch_selector}")
 
-        if (self.hutch_selector == 1):  # qRIXS
-            self.config = '/cds/group/laser/timing/lcls-drift-corr/qrixs_atm_fb.json'
+        if not self.follow_selector:
+            self.config = os.path.join(config_dir, config_file)
+            print(f"Using configuration {config_file}")
+        elif (self.hutch_selector == 1):  # qRIXS
+            self.config = os.path.join(config_dir, 'qrixs_atm_fb.json')
             print("Using qRIXS configuration")
         else:  # cRIXS
-            self.config = '/cds/group/laser/timing/lcls-drift-corr/crixs_atm_fb.json'
+            self.config = os.path.join(config_dir, 'crixs_atm_fb.json')
             print("Using cRIXS configuration")
 
         try:
             with open(self.config, 'r') as file:
                 self.hutch_config = json.load(file)
                 print("Configuration loaded successfully")
+            self.hutch_config.update(overrides or {})  # e.g. per-channel simulated PVs
         except json.JSONDecodeError as e:  # Check json file
             print('Invalid JSON syntax: '+str(e))
             raise
@@ -42,19 +98,38 @@ class drift_correction():
             print(f"Configuration loading failed: {e}")
             raise
 
-        # Values from ATM timetool PV
-        # only one should be uncommented at a time
+        # Values from ATM timetool PV, field layout from ttall_fields (standard: pos 1, ampl 2, FWHM 5)
         self.atm_err_pv = Pv(str(self.hutch_config['ttall_pv']))  # from json
-        # self.atm_err_pv = Pv('RIX:TIMETOOL:TTALL')  # timetool PV
-        # self.atm_err_pv = Pv('RIX:QRIX:ALV:01:TT:TTALL')  # Alvium TTALL
-        # self.atm_err_pv = Pv('CRIX:TIMETOOL:TTALL')  # cRIXS timetool PV
-        # self.atm_err_pv = Pv('QRIX:TIMETOOL:TTALL')  # qRIXS timetool PV
-
-        # script control PVs
-        self.heartbeat_pv = Pv('LAS:UNDS:FLOAT:41')
-        self.on_off_pv = Pv('LAS:UNDS:FLOAT:67')  # enable/disable correction
+        self.primary = ttall_source('ttall', self.atm_err_pv, self.hutch_config.get('ttall_fields'))
+        # further timetools, each with its own layout; accepted frames of one shot are fused
+        self.extra_sources = [ttall_source(source.get('name', source['pv']), Pv(str(source['pv'])), source.get('fields'),
+                                           source.get('pos_offset', 0.0), source.get('limits'))
+                              for source in self.hutch_config.get('ttall_sources', [])]
+        self.sources = [self.primary] + self.extra_sources
+        self.fusion_tolerance = self.hutch_config.get('fusion_tolerance', 0.004)
+        # 'monitor' queues every TTALL frame, 'poll' gets one per sample
+        self.ttall_mode = self.hutch_config.get('ttall_mode', 'poll')
+        self.ttall_monitor = None
+        if (self.ttall_mode == 'monitor'):
+            queue_size = self.hutch_config.get('ttall_queue_size', 1000)
+            self.ttall_monitor = ttall_monitor(self.atm_err_pv, queue_size)
+            for source in self.extra_sources:  # one wake-up event for all queues
+                source.monitor = ttall_monitor(source.pv, queue_size, ready=self.ttall_monitor.queue.ready)
+            print("Using TTALL monitor acquisition")
+        if self.extra_sources:
+            print(f"Fusing timetools: {', '.join(source.name for source in self.sources)}")
+        # poll mode with several timetools: one get per source in flight, all polled concurrently
+        self.poll_timeout = self.hutch_config.get('ttall_poll_timeout', 0.5)
+        self.poll_pool = None
+        if self.extra_sources and (self.ttall_monitor is None):
+            self.poll_pool = ThreadPoolExecutor(max_workers=len(self.sources), thread_name_prefix='ttall-poll',
+                                                initializer=self.backend.attach_thread)
+
+        # script control PVs, shared defaults unless the config names its own
+        self.heartbeat_pv = Pv(self.hutch_config.get('heartbeat_pv') or HEARTBEAT_PV)
+        self.on_off_pv = Pv(self.hutch_config.get('on_off_pv') or ON_OFF_PV)  # enable/disable correction
         # ATM feedback hook to adjust laser timing
-        self.atm_fb_pv = Pv('LAS:LHN:LLG2:02:PHASCTL:ATM_FBK_OFFSET')
+        self.atm_fb_pv = Pv(self.hutch_config.get('atm_fb_pv') or ATM_FB_PV)
         self.fb_direction_pv = Pv(str(self.hutch_config['fb_direction_pv']))
         self.fb_gain_pv = Pv(str(self.hutch_config['fb_gain_pv']))
         self.pos_offset_pv = Pv(str(self.hutch_config['pos_offset_pv']))  # fs
@@ -83,182 +158,785 @@ class drift_correction():
         self.correction_pv = Pv(str(self.hutch_config['correction_pv']))
         # TXT stage position
         self.txt_pv = Pv(str(self.hutch_config['txt_pv']))
+        # TXT motion from monitors of the readback and (optional) motor DMOV/MOVN;
+        # frames are classified against the motion history by their timestamps
+        self.txt_tracker = motion_tracker(self.txt_pv, self.optional_pv('txt_dmov_pv'),
+                                          self.optional_pv('txt_movn_pv'),
+                                          settle=self.hutch_config.get('txt_settle_time', 0.5))
         self.filter_state_pv = Pv(str(self.hutch_config['filter_state_pv']))
+        # full rejection bitmask of the latest frame (optional)
+        self.filter_mask_pv = self.optional_pv('filter_mask_pv')
+        # rolling per-reason rejection counts, one waveform at a throttled rate (optional)
+        self.rejections = rejection_window(self.hutch_config.get('filter_stats_window', 10.0))
+        self.filter_stats_pv = self.optional_pv('filter_stats_pv')
+        self.filter_stats_interval = self.hutch_config.get('filter_stats_interval', 1.0)
+        self.filter_stats_published = 0.0
+        # filter limits from rolling quantiles of the signal: 'off', 'propose' or 'apply' (written to the limit PVs)
+        self.auto_limits = self.hutch_config.get('auto_limits', 'off')
+        self.tuner = None
+        if (self.auto_limits != 'off'):
+            self.tuner = limit_tuner(self.hutch_config.get('auto_limit_window', 60.0),
+                                     width=self.hutch_config.get('auto_limit_width', 5.0),
+                                     step=self.hutch_config.get('auto_limit_step', 0.25))
+        self.auto_limit_interval = self.hutch_config.get('auto_limit_interval', 10.0)
+        self.auto_limits_tuned = time.monotonic()
+        self.proposed_limits = {}
+        # waveform of the proposed limits in FILTER_LIMITS order (optional)
+        self.auto_limits_pv = self.optional_pv('auto_limits_pv')
+
+        # control parameters served from monitors instead of per-cycle gets
+        self.params = param_cache({
+            'hutch_selector': self.hutch_selector_pv,
+            'pos_offset': self.pos_offset_pv,
+            'ampl_min': self.ampl_min_pv,
+            'ampl_max': self.ampl_max_pv,
+            'fwhm_min': self.fwhm_min_pv,
+            'fwhm_max': self.fwhm_max_pv,
+            'pos_fs_min': self.pos_fs_min_pv,
+            'pos_fs_max': self.pos_fs_max_pv,
+            'sample_size': self.sample_size_pv,
+            'avg_mode': self.avg_mode_pv,
+            'decay_factor': self.decay_factor_pv,
+            'fb_direction': self.fb_direction_pv,
+            'fb_gain': self.fb_gain_pv,
+            'on_off': self.on_off_pv,
+        })
+        # optional output PVs
+        self.phase_time_pv = self.optional_pv('phase_time_pv')
+        self.cycle_period_pv = self.optional_pv('cycle_period_pv')
+        # waveform of the Allan deviation (fs) per averaging size, and the sample size in use
+        self.allan_pv = self.optional_pv('allan_pv')
+        self.sample_window_pv = self.optional_pv('sample_window_pv')
+        # spectra of the error stream and the corrections, from a background worker
+        self.spectrum_pvs = {name: self.optional_pv(key) for name, key in SPECTRUM_PVS.items()}
+
+        # all channels connect at once, then the monitors start
+        connect_time, connected = self.backend.connect_all(timeout=1.0)
+        if self.ttall_monitor is not None:
+            self.ttall_monitor.start()
+            for source in self.extra_sources:
+                source.monitor.start()
+        self.txt_tracker.start()
+        self.params.start()
+
+        # Allan deviation of the accepted position error with the loop's own corrections added back,
+        # at averaging sizes 1, 2, 4 ... samples; auto_sample_size uses the size at its minimum
+        self.allan = allan_deviation(self.hutch_config.get('allan_levels', 12),
+                                     self.hutch_config.get('allan_memory', 100))
+        self.auto_sample_size = self.hutch_config.get('auto_sample_size', False)
+        self.loop_offset = 0.0  # sum of the expected responses (fs) of the applied corrections
 
         # parameter and container initialization
-        self.ampl_vals = deque()
-        self.fwhm_vals = deque()
-        self.error_vals = deque()
-        self.max_fill_iterations = 500  # buffer for timeout
+        self.sample_size = self.pull_sample_size()
+        self.ampl_vals = ring_buffer(self.sample_size)
+        self.fwhm_vals = ring_buffer(self.sample_size)
+        self.error_vals = ring_buffer(self.sample_size)
+        # decaying median of error_vals, kept in step with the buffer
+        self.error_median = decaying_median(self.params.get('decay_factor'))
+        # avg_mode 4: offset and drift rate estimate updated by every accepted sample
+        self.kalman = drift_kalman(self.hutch_config.get('kalman_meas_noise', 30.0),
+                                   self.hutch_config.get('kalman_process_noise', 1.0))
+        # avg_mode 5: streaming (P-squared) median of the fill, no sort and no stored samples
+        self.error_p2 = p2_quantile(0.5)
+        # avg_modes 5 and 6: Hampel test of each position error against a running median and MAD
+        self.gate = hampel_gate(self.hutch_config.get('hampel_k', 3.0), self.hutch_config.get('hampel_memory', 0.05))
+        self.outlier_count = 0  # samples rejected by the gate
+        self.avg_mode = self.params.get('avg_mode')
+        self.fill_new = 0  # samples pushed since start_fill
+        # accepted samples left over from a batch once the buffer is full, bounded by age
+        self.pending = deque()
+        self.pending_max_age = self.hutch_config.get('pending_max_age', 5.0)  # s before the newest sample
+        self.pending_dropped = 0  # pending samples dropped as too old
+        self.clock = time.time  # time base of frame stamps, the replay runs on recorded time
+        self.applied_stamp = None  # time of the last ATM FB write, older frames predate its effect
+        self.stale_count = 0  # pending samples dropped as older than the last write
+        self.frame_count = 0  # frames run through the filter
+        self.accept_count = 0  # frames that passed the filter
+        self.correction_count = 0  # corrections computed
+
+        # per-phase timing of correct(), published every metrics_interval seconds
+        self.timer = phase_timer()
+        self.metrics_interval = self.hutch_config.get('metrics_interval', 10.0)
+        self.metrics_file = self.hutch_config.get('metrics_file')
+        # phase_time_pv: waveform of p50, p99, max (ms) for each phase in PHASES order
+        # cycle_period_pv: waveform of mean, jitter, p99, max (ms) of the correction cycle period
+        self.metrics_published = time.monotonic()
+        self.queue_dropped = 0  # TTALL queue drops already reported
+
+        # cycle scheduling: 'sleep' waits a fixed 100 ms after each cycle, 'frames' starts
+        # the next cycle at once, paced by accepted frames
+        self.schedule_mode = self.hutch_config.get('schedule_mode', 'sleep')
+        self.cycle_sleep = 0.1 if (self.schedule_mode == 'sleep') else 0.0
+        # a fill ends at cycle_deadline; with min_samples accepted it makes a correction
+        # scaled by the filled fraction of the buffer, otherwise none. None is no deadline,
+        # 'auto' cycle_deadline_margin times the nominal fill time at the measured accepted rate
+        self.cycle_deadline = self.hutch_config.get('cycle_deadline')
+        self.deadline_margin = self.hutch_config.get('cycle_deadline_margin', 3.0)
+        self.min_samples = self.hutch_config.get('min_samples', 10)
+        self.fill_deadline = None
+        self.fill_started = None
+        self.accept_rate = None  # accepted frames per second of fill time, smoothed over fills
+        self.fill_weight = 1.0  # confidence of the current correction, filled fraction of the buffer
+        self.acceptance = float('nan')  # accepted fraction of the frames of the last fill
+        self.partial_count = 0  # corrections made from a partly filled buffer
+        self.deadline_count = 0  # fills ended by the deadline without a correction
+        # accepted fraction of the frames of each fill (optional)
+        self.acceptance_pv = self.optional_pv('acceptance_pv')
+        # drift rate estimate in fs/s, published in avg_mode 4 (optional)
+        self.drift_rate_pv = self.optional_pv('drift_rate_pv')
+
+        # raw frame / decision / correction recorder for post-mortem analysis
+        self.avg_error = float('nan')
+        self.correction = 0.0
+        self.atm_fb = float('nan')  # read at each correction; the asyncio loop reads it alongside the fill
+        self.recorder = None
+        if self.hutch_config.get('record_dir'):
+            self.recorder = frame_recorder(self.hutch_config['record_dir'], record_prefix(self.config),
+                                           segment_records=self.hutch_config.get('record_segment_records', 1 << 20),
+                                           keep_segments=self.hutch_config.get('record_keep_segments'))
+            print(f"Recording frames to {self.hutch_config['record_dir']}")
+
+        # background spectral analysis, when any of its PVs is configured
+        self.spectrum = None
+        if any(pv is not None for pv in self.spectrum_pvs.values()):
+            self.spectrum = spectrum_worker(self.publish_spectrum,
+                                            capacity=self.hutch_config.get('spectrum_samples', 65536),
+                                            rate=self.hutch_config.get('spectrum_rate', 10.0),
+                                            segment=self.hutch_config.get('spectrum_segment', 256),
+                                            interval=self.hutch_config.get('spectrum_interval', 30.0),
+                                            attach=self.backend.attach_thread)
+            self.spectrum.start()
+
+        # startup report
+        for line in self.backend.registry.report(connect_time, connected):
+            print(line)
+        print(f"[INFO] Ready in {(time.perf_counter() - init_start) * 1000:.1f} ms")
 
     def pull_filter_limits(self):
-        """pulls current filtering thresholds from PVs"""
-        self.ampl_min = self.ampl_min_pv.get(timeout=1.0)
-        self.ampl_max = self.ampl_max_pv.get(timeout=1.0)
-        self.fwhm_min = self.fwhm_min_pv.get(timeout=1.0)
-        self.fwhm_max = self.fwhm_max_pv.get(timeout=1.0)
-        self.pos_fs_min = self.pos_fs_min_pv.get(timeout=1.0)
-        self.pos_fs_max = self.pos_fs_max_pv.get(timeout=1.0)
+        """pulls current filtering thresholds and position offset from the cache"""
+        self.limits_version = self.params.version_of(*LIMIT_PARAMS)
+        self.limits = {name: self.params.get(name) for name in FILTER_LIMITS}
+        self.flt_pos_offset = self.params.get('pos_offset')
+
+    def optional_pv(self, key):
+        """Pv for an optional config entry, None when absent or empty"""
+        name = self.hutch_config.get(key)
+        return self.backend.pv(str(name)) if name else None
+
+    def close(self):
+        """stops PV monitors before the instance is discarded"""
+        if self.ttall_monitor is not None:
+            self.ttall_monitor.stop()
+            for source in self.extra_sources:
+                source.monitor.stop()
+        self.params.stop()
+        self.txt_tracker.stop()
+        if self.spectrum is not None:
+            self.spectrum.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.poll_pool is not None:
+            self.poll_pool.shutdown(wait=False)  # gets in flight end with their own timeout
+
+    def pull_sample_size(self):
+        """sample size from the cache as a buffer capacity, in auto mode the Allan minimum up to that size"""
+        sample_size = max(int(round(self.params.get('sample_size'))), 1)
+        if self.auto_sample_size:
+            best = self.allan.best_size()
+            if best is not None:
+                sample_size = min(best, sample_size)
+        return sample_size
+
+    def resize_buffers(self):
+        """bounds the sample buffers to the current sample size"""
+        for vals in (self.ampl_vals, self.fwhm_vals, self.error_vals):
+            vals.resize(self.sample_size)
+        while (len(self.error_median) > len(self.error_vals)):
+            self.error_median.pop_oldest()
+
+    def push_sample(self, stamp, ampl, fwhm, pos_fs):
+        """adds an accepted sample to the buffers and estimators"""
+        if (self.avg_mode in (5, 6)) and not self.gate.accept(pos_fs):
+            self.outlier_count += 1
+            return
+        if (len(self.error_vals) == self.error_vals.capacity):
+            self.pop_sample()
+        self.ampl_vals.append(ampl)
+        self.fwhm_vals.append(fwhm)
+        self.error_vals.append(pos_fs)
+        self.error_median.push(pos_fs)
+        if (self.avg_mode == 4):  # FWHM / amplitude as the measurement noise proxy
+            self.kalman.update(stamp, pos_fs, fwhm / ampl if ampl else float('inf'))
+        elif (self.avg_mode == 5):
+            self.error_p2.add(pos_fs)
+        self.fill_new += 1
+
+    def pop_sample(self):
+        """removes the oldest sample from the buffers and estimators"""
+        self.ampl_vals.popleft()
+        self.fwhm_vals.popleft()
+        self.error_vals.popleft()
+        self.error_median.pop_oldest()
+
+    def clear_samples(self):
+        """empties the buffers and estimators"""
+        self.ampl_vals.clear()
+        self.fwhm_vals.clear()
+        self.error_vals.clear()
+        self.error_median.clear()
+        self.kalman.reset()
+        self.error_p2.clear()
+
+    def reset(self):
+        """drops samples, queued frames and the last estimate, e.g. when this hutch becomes active"""
+        self.clear_samples()
+        self.pending.clear()
+        self.applied_stamp = None
+        self.fill_started = None  # the standby time is no fill
+        self.gate.clear()
+        self.allan.clear()
+        self.loop_offset = 0.0
+        self.proposed_limits = {}
+        if self.spectrum is not None:
+            self.spectrum.clear()
+        if self.ttall_monitor is not None:
+            self.ttall_monitor.clear()
+            self.queue_dropped = self.ttall_monitor.dropped  # drops while on standby are not reported
+        for source in self.sources:
+            if source.monitor is not None:
+                source.monitor.clear()
+            source.reset()
+        self.avg_error = float('nan')
+        self.correction = 0.0
+
+    def publish_metrics(self):
+        """publishes the phase timings of the last window and starts a new one"""
+        snapshot = self.timer.snapshot()
+        if self.phase_time_pv is not None:
+            self.phase_time_pv.put(value=[snapshot[phase][stat] * 1000 for phase in PHASES
+                                          for stat in ('p50', 'p99', 'max')], timeout=1.0)
+        if self.cycle_period_pv is not None:
+            self.cycle_period_pv.put(value=[value * 1000 for value in self.timer.period_snapshot().values()],
+                                     timeout=1.0)
+        if self.allan_pv is not None:
+            self.allan_pv.put(value=self.allan.deviation(), timeout=1.0)
+        if self.sample_window_pv is not None:
+            self.sample_window_pv.put(value=self.sample_size, timeout=1.0)
+        extra = {
+            'frames_filtered_total': self.frame_count,
+            'frames_accepted_total': self.accept_count,
+            'partial_corrections_total': self.partial_count,
+            'deadline_cycles_total': self.deadline_count,
+            'outliers_rejected_total': self.outlier_count,
+            'stale_samples_dropped_total': self.stale_count,
+            'pending_samples_dropped_total': self.pending_dropped,
+            'pending_depth': len(self.pending),
+            'sample_window': self.sample_size,
+            'fill_acceptance': self.acceptance,
+            'window_acceptance': self.rejections.acceptance(),
+        }
+        extra.update({f'auto_{name}': value for name, value in self.proposed_limits.items()})
+        extra.update({f'window_{column}': int(count) for column, count in zip(WINDOW_COLUMNS, self.rejections.totals)})
+        for source in self.sources:
+            extra[f'source_accepted_total{{source="{source.name}"}}'] = source.accepted
+            extra[f'source_noise_fs{{source="{source.name}"}}'] = \
+                float('nan') if (source.variance is None) else source.variance ** 0.5
+        queue = getattr(self.ttall_monitor, 'queue', None)  # None when polling or replaying
+        if queue is not None:
+            if queue.dropped > self.queue_dropped:  # loop fell behind the timetool
+                print(f"[INFO] TTALL queue overflow: {queue.dropped - self.queue_dropped} frames dropped, "
+                      f"high water {queue.high_water}/{queue.capacity}")
+            self.queue_dropped = queue.dropped
+            extra.update({
+                'frames_received_total': queue.received,
+                'frames_dropped_total': queue.dropped,
+                'queue_overflows_total': queue.overflows,
+                'queue_depth': len(queue),
+                'queue_high_water': queue.high_water,
+            })
+        if self.metrics_file:
+            write_metrics_file(self.metrics_file, self.timer, extra)
+        self.timer.reset()
+        self.metrics_published = time.monotonic()
+
+    def publish_spectrum(self, results):
+        """puts the spectrum_worker results to their PVs, on the worker thread"""
+        for name, pv in self.spectrum_pvs.items():
+            if pv is not None:
+                pv.put(value=results[name].tolist(), timeout=1.0)
 
     def pull_atm_values(self):
-        """pulls current atm values"""
-        self.atm_err = self.atm_err_pv.get(timeout=60.0)
-        # standard order
-        self.atm_err_pos_ps = self.atm_err[1]  # pos ps
-        self.atm_err_amp = self.atm_err[2]  # amplitude
-        self.atm_err_fwhm = self.atm_err[5]  # FWHM
-        # piranha special
-        # self.atm_err_pos_ps = self.atm_err[2]  # pos ps
-        # self.atm_err_amp = self.atm_err[0]  # amplitude
-        # self.atm_err_fwhm = self.atm_err[3]  # FWHM
+        """pulls the next batch of atm values, one row per TTALL frame"""
+        try:
+            if self.extra_sources:
+                self.batches = self.pull_sources()
+            elif self.ttall_monitor is not None:  # all queued frames, each used once
+                self.batches = [(self.primary, *self.ttall_monitor.drain(timeout=self.fill_timeout()))]
+            else:
+                frame = np.atleast_2d(np.asarray(self.atm_err_pv.get(timeout=self.fill_timeout()), dtype=float))
+                self.batches = [(self.primary, np.array([self.clock()]), frame)]
+        except frame_timeout:
+            if self.fill_deadline is None:
+                raise
+            raise cycle_deadline_reached
+        # the first source with frames, normally the primary timetool, drives tracking and filter state
+        self.lead, self.atm_err_stamps, self.atm_err = self.batches[0]
+        self.atm_err_pos_ps, self.atm_err_amp, self.atm_err_fwhm = self.lead.columns(self.atm_err)
         # calculate offset adjusted position in fs
-        # self.flt_pos_fs = (self.atm_err_pos_ps * 1000) - self.flt_pos_offset
         self.atm_err_pos_fs = (self.atm_err_pos_ps * 1000)
 
-    def correct(self):
-        """filters data and applies correction"""
-        # Check for hutch value change
-        self.hutch_selector_new = self.hutch_selector_pv.get(timeout=1.0)
+    def pull_sources(self):
+        """(source, stamps, frames) of every timetool with new frames, waiting for the first of any"""
+        if self.ttall_monitor is not None:
+            monitors = [self.ttall_monitor] + [source.monitor for source in self.extra_sources]
+            wait_any([monitor.queue for monitor in monitors], self.ttall_monitor.queue.ready, self.fill_timeout())
+            return [(source, *monitor.drain(timeout=0.0)) for source, monitor in zip(self.sources, monitors)
+                    if len(monitor.queue)]
+        # polling: concurrent gets with a short timeout each, a slow or dead source is skipped
+        give_up = time.monotonic() + 60.0
+        while True:
+            for source in self.sources:  # a get still in flight from an earlier round is not repeated
+                if source.poll is None:
+                    source.poll = self.poll_pool.submit(source.pv.get, timeout=self.poll_timeout)
+            # wait only for sources that answered last time, the others are taken if they have by then
+            waiting = [source.poll for source in self.sources if source.responsive]
+            wait(waiting or [source.poll for source in self.sources], timeout=self.fill_timeout(self.poll_timeout))
+            batches = []
+            for source in self.sources:
+                if not source.poll.done():
+                    source.set_responsive(False, f"no answer within {self.poll_timeout} s")
+                    continue
+                future, source.poll = source.poll, None
+                try:
+                    frame = np.atleast_2d(np.asarray(future.result(), dtype=float))
+                except Exception as e:
+                    source.set_responsive(False, f"get failed: {e}")
+                    continue
+                source.set_responsive(True)
+                batches.append((source, np.array([self.clock()]), frame))
+            if batches:
+                return batches
+            if all(source.poll is None for source in self.sources) or (time.monotonic() > give_up):
+                raise frame_timeout  # every get failed, or nothing answered in time
+
+    def check_hutch(self):
+        """raises hutch_selection_changed when the hutch selector moved"""
+        if not self.follow_selector:
+            return
+        self.hutch_selector_new = self.params.get('hutch_selector')
         if (self.hutch_selector_new != self.hutch_selector):  # hutch change
             print("[DEBUG] Hutch change detected, raising exception")
             raise hutch_selection_changed
-        # === Update values ===
-        # get latest position offset
-        self.flt_pos_offset = self.pos_offset_pv.get(timeout=1.0)
-        self.pull_atm_values()
-        # get current ATM FB hook value
-        self.atm_fb = self.atm_fb_pv.get(timeout=60.0)
+
+    def start_fill(self):
+        """pulls settings for a new fill of the sample buffer"""
         self.pull_filter_limits()
-        # get TXT position
-        self.txt_prev = round(self.txt_pv.get(timeout=1.0), 1)
-        self.bad_count = 0  # track how many times filter thresholds not met
-        self.sample_size = self.sample_size_pv.get(timeout=1.0)
-        # ============== loop for filling sample ======================
-        # Initialize safety counter
-        loop_counter = 0
-        while (len(self.error_vals) < self.sample_size):
-            loop_counter += 1
-            if loop_counter > self.max_fill_iterations:
-                raise buffer_fill_timeout
-            # get current PV values
-            self.pull_atm_values()
-            self.curr_flt_pos_fs = self.atm_err_pos_fs - self.flt_pos_offset
-            # check if filtering parameters have been updated
-            if (self.bad_count > 9):
-                self.pull_filter_limits()
-                self.flt_pos_offset = self.pos_offset_pv.get(timeout=1.0)
-                self.bad_count = 0
-            # update tracking PVs
-            self.curr_pos_fs_pv.put(value=self.atm_err_pos_fs, timeout=1.0)
-            self.curr_ampl_pv.put(value=self.atm_err_amp, timeout=1.0)
-            self.curr_fwhm_pv.put(value=self.atm_err_fwhm, timeout=1.0)
-            # self.avg_pos_error.put(value=self.curr_flt_pos_fs, timeout=1.0)
+        self.sample_size = self.pull_sample_size()
+        if (self.sample_size != self.error_vals.capacity):
+            self.resize_buffers()  # keeps the newest samples that still fit
+        avg_mode = self.params.get('avg_mode')
+        if (avg_mode != self.avg_mode) and (avg_mode >= 4):
+            # the streaming estimators start from the samples taken in their mode
+            self.clear_samples()
+            self.gate.clear()
+        self.avg_mode = avg_mode
+        self.fill_new = 0
+        self.fill_weight = 1.0
+        now = time.monotonic()
+        if self.fill_started is not None:  # accepted rate over the previous fill
+            elapsed = now - self.fill_started
+            if elapsed > 0:
+                rate = (self.accept_count - self.fill_start_counts[1]) / elapsed
+                self.accept_rate = rate if (self.accept_rate is None) else 0.7 * self.accept_rate + 0.3 * rate
+        self.fill_started = now
+        self.fill_start_counts = (self.frame_count, self.accept_count)
+        deadline = self.deadline_seconds()
+        self.fill_deadline = None if (deadline is None) else now + deadline
+
+    def deadline_seconds(self):
+        """fill deadline of this cycle in seconds (at most 60 in auto mode), None for none"""
+        if (self.cycle_deadline != 'auto'):
+            return self.cycle_deadline
+        if not self.accept_rate:  # nothing measured yet, or nothing accepted lately
+            return 60.0
+        return min(self.deadline_margin * self.sample_size / self.accept_rate, 60.0)
+
+    def fill_timeout(self, timeout=60.0):
+        """time left to wait for frames, raises cycle_deadline_reached once the deadline passed"""
+        if self.fill_deadline is None:
+            return timeout
+        remaining = self.fill_deadline - time.monotonic()
+        if (remaining <= 0):
+            raise cycle_deadline_reached
+        return min(timeout, remaining)
+
+    def update_acceptance(self):
+        """accepted fraction of the frames filtered since start_fill"""
+        frames = self.frame_count - self.fill_start_counts[0]
+        accepted = self.accept_count - self.fill_start_counts[1]
+        self.acceptance = accepted / frames if frames else float('nan')
+        return self.acceptance
+
+    def partial_fill(self):
+        """handles an expired fill deadline, raises cycle_deadline_reached with too few samples"""
+        filled = len(self.error_vals)
+        self.update_acceptance()
+        # a rolling buffer with no new sample would repeat the last correction
+        if (self.fill_new == 0) or (filled < self.min_samples):
+            self.deadline_count += 1
+            raise cycle_deadline_reached
+        self.fill_weight = filled / self.sample_size
+        self.partial_count += 1
+
+    def end_deadline_cycle(self):
+        """publishes the acceptance rate of a fill that ended without a correction"""
+        if self.acceptance_pv is not None:
+            self.acceptance_pv.put(value=self.acceptance, timeout=1.0)
+        self.publish_due()
+
+    def fill_from_pending(self):
+        """moves accepted samples left over from earlier batches into the buffer, True once full
+
+        Samples stamped before the last applied ATM FB write are dropped
+        first, so a backlog never feeds a correction that is already out of
+        date. The rolling modes take every pending sample, the buffer keeps
+        the newest, and correct once per batch.
+        """
+        if self.applied_stamp is not None:
+            while self.pending and (self.pending[0][0] < self.applied_stamp):
+                self.pending.popleft()
+                self.stale_count += 1
+        if (self.avg_mode == 4):  # no buffer to fill, every new sample updates the estimate
+            while self.pending:
+                self.push_sample(*self.pending.popleft())
+            return self.fill_new > 0
+        if (self.avg_mode in (2, 3)):
+            while self.pending:
+                self.push_sample(*self.pending.popleft())
+            return (self.fill_new > 0) and (len(self.error_vals) >= self.sample_size)
+        while self.pending and (len(self.error_vals) < self.sample_size):
+            self.push_sample(*self.pending.popleft())
+        return len(self.error_vals) >= self.sample_size
+
+    def trim_pending(self):
+        """drops pending samples more than pending_max_age older than the newest, counting them"""
+        if not self.pending:
+            return
+        oldest = self.pending[-1][0] - self.pending_max_age
+        while self.pending[0][0] < oldest:
+            self.pending.popleft()
+            self.pending_dropped += 1
+
+    def fuse_samples(self, samples):
+        """one inverse-variance weighted sample per shot from the accepted samples of each source
+
+        Amplitude and FWHM are put on the scale of the primary timetool (the
+        first source with levels) before averaging. Samples of a shot whose
+        other frames may still arrive are held back for the next batch.
+        """
+        reference = next((source for source in self.sources if source.levels is not None), self.primary)
+        batches = []
+        for source in self.sources:
+            stamps, ampl, fwhm, pos_fs = samples.get(source, (np.zeros(0),) * 4)
+            columns = (stamps, *source.scaled(ampl, fwhm, reference), pos_fs)
+            if source.held is not None:
+                columns = tuple(np.concatenate(pair) for pair in zip(source.held, columns))
+            batches.append((*columns, source.variance))
+        *fused, counts, held = fuse(batches, self.fusion_tolerance, now=self.clock())
+        for source, columns in zip(self.sources, held):
+            source.held = columns
+        return fused
+
+    def tracking_puts(self):
+        """(pv, value) tracking updates for the newest frame of the batch"""
+        return [(self.curr_pos_fs_pv, self.atm_err_pos_fs[-1]),
+                (self.curr_ampl_pv, self.atm_err_amp[-1]),
+                (self.curr_fwhm_pv, self.atm_err_fwhm[-1])]
+
+    def filter_batch(self):
+        """filters the pulled batch and queues the accepted samples"""
+        # check if filtering parameters have been updated
+        if (self.params.version_of(*LIMIT_PARAMS) != self.limits_version):
+            self.pull_filter_limits()
+        samples = {}  # accepted (stamps, ampl, fwhm, pos_fs) per source
+        for source, stamps, frames in self.batches:
+            pos_ps, ampl, fwhm = source.columns(frames)
+            pos_fs = pos_ps * 1000 - self.flt_pos_offset - source.pos_offset
             # ============= check and update filter state ==============
-            self.filter_state = 0  # 0: passes all filter conditions
-            if not (self.atm_err_amp > self.ampl_min):
-                self.filter_state = 1  # amplitude too low
-            if not (self.atm_err_amp < self.ampl_max):
-                self.filter_state = 2  # amplitude too high
-            if not (self.atm_err_fwhm > self.fwhm_min):
-                self.filter_state = 3  # FWHM too low
-            if not (self.atm_err_fwhm < self.fwhm_max):
-                self.filter_state = 4  # FWHM too high
-            if not (self.curr_flt_pos_fs > self.pos_fs_min):
-                self.filter_state = 5  # position too low
-            if not (self.curr_flt_pos_fs < self.pos_fs_max):
-                self.filter_state = 6  # position too high
-            # if not (self.flt_pos_fs != self.curr_flt_pos_fs):
-            #     self.filter_state = 7  # position the same
-            if not (round(self.txt_pv.get(timeout=1.0), 1) == self.txt_prev):
-                self.filter_state = 8  # txt stage is moving
-            # update filter state
-            self.filter_state_pv.put(value=self.filter_state, timeout=1.0)
-            if (self.filter_state == 0):
+            # txt stage is moving if a frame falls in a motion or settle window
+            txt_moving = self.txt_tracker.moving_mask(stamps)
+            mask = filter_frames(ampl, fwhm, pos_fs, source.source_limits(self.limits), txt_moving=txt_moving)
+            accepted = (mask == 0)
+            self.rejections.add(mask)
+            self.frame_count += len(accepted)
+            self.accept_count += int(accepted.sum())
             # if True:  # DEBUG LINE - bypasses all filtering
-                self.ampl = self.atm_err_amp  # unpack ampl filter parameter
-                self.fwhm = self.atm_err_fwhm  # unpack fwhm filter parameter
-                self.flt_pos_fs = self.curr_flt_pos_fs
-                self.ampl_vals.append(self.ampl)
-                self.fwhm_vals.append(self.fwhm)
-                self.error_vals.append(self.flt_pos_fs)
-                self.bad_count = 0
-            else:
-                self.bad_count += 1
-            # update txt position for filtering
-            self.txt_prev = round(self.txt_pv.get(timeout=1.0), 1)
-        # ============= averaging ===============
-        self.avg_mode = self.avg_mode_pv.get(timeout=1.0)
+            source.update_noise(pos_fs[accepted])
+            source.update_levels(ampl[accepted], fwhm[accepted])
+            samples[source] = (stamps[accepted], ampl[accepted], fwhm[accepted], pos_fs[accepted])
+            if source is self.lead:
+                self.curr_flt_pos_fs, self.filter_mask, lead_moving = pos_fs, mask, txt_moving
+        # codes are bits of the mask (see drift_correction_filter)
+        self.filter_state = filter_state(self.filter_mask[-1])
+        if self.extra_sources:
+            stamps, ampl, fwhm, pos_fs = self.fuse_samples(samples)
+        else:
+            stamps, ampl, fwhm, pos_fs = samples[self.primary]
+        self.pending.extend(zip(stamps, ampl, fwhm, pos_fs))
+        self.trim_pending()
+        for value in pos_fs:
+            self.allan.add(value + self.loop_offset)
+        if self.spectrum is not None:
+            self.spectrum.add_errors(stamps, pos_fs, self.loop_offset)
+        if self.lead is not self.primary:
+            return  # the tuner and the recorder follow the primary timetool
+        if self.tuner is not None:
+            # frames taken while TXT is still, with their masks under the current limits
+            still = ~lead_moving
+            self.tuner.add(self.atm_err_amp[still], self.atm_err_fwhm[still], self.curr_flt_pos_fs[still],
+                           self.filter_mask[still])
+        if self.recorder is not None:
+            self.recorder.record_frames(self.atm_err_stamps, self.atm_err, self.filter_mask,
+                                        self.txt_tracker.position, self.avg_error, self.correction, self.atm_fb)
+
+    def filter_puts(self):
+        """(pv, value) filter state updates for the newest frame of the batch"""
+        puts = [(self.filter_state_pv, self.filter_state)]
+        if self.filter_mask_pv is not None:
+            puts.append((self.filter_mask_pv, int(self.filter_mask[-1])))
+        if (self.filter_stats_pv is not None) and \
+                (time.monotonic() - self.filter_stats_published >= self.filter_stats_interval):
+            self.filter_stats_published = time.monotonic()
+            puts.append((self.filter_stats_pv, self.rejections.waveform()))
+        return puts
+
+    def average(self):
+        """updates the averages from the full buffer, False if there is no data"""
+        # avg_mode was pulled by start_fill, so the estimator matches the samples of this fill
         # Check if we have any data to average
         if len(self.ampl_vals) == 0:
-            return  # Skip this iteration if no valid data
+            return False  # Skip this iteration if no valid data
         # Check for average mode
         # ONLY block averaging has been tested
         if (self.avg_mode == 1):  # block averaging
-            self.avg_ampl = sum(self.ampl_vals) / len(self.ampl_vals)
-            self.avg_fwhm = sum(self.fwhm_vals) / len(self.fwhm_vals)
-            self.avg_error = sum(self.error_vals) / len(self.error_vals)
-            # clear deques completely for next iteration
-            self.ampl_vals.clear()
-            self.fwhm_vals.clear()
-            self.error_vals.clear()
+            self.avg_ampl = self.ampl_vals.mean()
+            self.avg_fwhm = self.fwhm_vals.mean()
+            self.avg_error = self.error_vals.mean()
+            # clear buffers completely for next iteration
+            self.clear_samples()
         elif (self.avg_mode == 2):  # moving average
-            self.avg_ampl = sum(self.ampl_vals) / len(self.ampl_vals)
-            self.avg_fwhm = sum(self.fwhm_vals) / len(self.fwhm_vals)
-            self.avg_error = sum(self.error_vals) / len(self.error_vals)
-            # remove oldest element from deques
-            self.ampl_vals.popleft()
-            self.fwhm_vals.popleft()
-            self.error_vals.popleft()
+            self.avg_ampl = self.ampl_vals.mean()
+            self.avg_fwhm = self.fwhm_vals.mean()
+            self.avg_error = self.error_vals.mean()
+            # remove oldest element from buffers
+            self.pop_sample()
+        elif (self.avg_mode == 4):  # Kalman estimate of offset and drift rate
+            # moving average for amplitude and FWHM over the last sample_size samples
+            self.avg_ampl = self.ampl_vals.mean()
+            self.avg_fwhm = self.fwhm_vals.mean()
+            # offset at the newest sample; the buffers keep rolling, nothing is removed
+            self.avg_error = self.kalman.offset
+        elif (self.avg_mode == 5):  # streaming median of the gated samples
+            self.avg_ampl = self.ampl_vals.mean()
+            self.avg_fwhm = self.fwhm_vals.mean()
+            self.avg_error = self.error_p2.value()
+            self.clear_samples()
+        elif (self.avg_mode == 6):  # block average of the gated samples
+            self.avg_ampl = self.ampl_vals.mean()
+            self.avg_fwhm = self.fwhm_vals.mean()
+            self.avg_error = self.error_vals.mean()
+            self.clear_samples()
         else:  # decaying median filter
             # first, calculate moving average for amplitude and FWHM
-            self.avg_ampl = sum(self.ampl_vals) / len(self.ampl_vals)
-            self.avg_fwhm = sum(self.fwhm_vals) / len(self.fwhm_vals)
+            self.avg_ampl = self.ampl_vals.mean()
+            self.avg_fwhm = self.fwhm_vals.mean()
             # then calculate decaying median position
-            self.decay_factor = self.decay_factor_pv.get(timeout=1.0)
-            current_size = len(self.error_vals)  # Use actual deque size
-            self.weights = [self.decay_factor ** (self.sample_size - i - 1) for i in range(current_size)]  # calculate weight of each element in deque
-            self.weighted_values = [(self.error_vals[i], self.weights[i]) for i in range(current_size)]  # elements are paired with weights
-            self.sorted_values = sorted(self.weighted_values, key=lambda x: x[0])  # sort element/weight pairs by element value
-            self.cumulative_weights = np.cumsum([val[1] for val in self.sorted_values])  # calculate the cumulative weight
-            self.total_weight = self.cumulative_weights[-1]
-            self.target_weight = self.total_weight / 2
-            # set to a default value in case loop doesn't execute
-            self.avg_error = self.error_vals[-1] if len(self.error_vals) > 0 else 0
-            # loop through until target weight reached
-            for value, cum_weight in zip([val[0] for val in self.sorted_values], self.cumulative_weights):
-                if cum_weight >= self.target_weight:
-                    self.avg_error = value
-                    break
-            # remove oldest element from deques
-            self.ampl_vals.popleft()
-            self.fwhm_vals.popleft()
-            self.error_vals.popleft()
-        # ======= updates PVs & apply correction =================
-        # update average value PVs of filter parameters and error
-        self.ampl_pv.put(value=self.avg_ampl, timeout=1.0)
-        self.fwhm_pv.put(value=self.avg_fwhm, timeout=1.0)
-        # put average error to PV
-        self.avg_pos_error.put(value=self.avg_error, timeout=1.0)
+            self.decay_factor = self.params.get('decay_factor')
+            if (self.decay_factor != self.error_median.decay_factor):
+                self.error_median.set_decay_factor(self.decay_factor)  # re-weights all samples
+            # newest sample has weight 1, each older one is scaled by decay_factor
+            self.avg_error = self.error_median.median()
+            # remove oldest element from buffers
+            self.pop_sample()
+        return True
+
+    def compute_correction(self):
+        """scales the average error to an ATM FB step, True if it should be written"""
         # update control parameters and apply correction
-        self.fb_direction = self.fb_direction_pv.get(timeout=1.0)
-        self.fb_gain = self.fb_gain_pv.get(timeout=1.0)
-        self.on_off = self.on_off_pv.get(timeout=1.0)
-        # scale to ns, direction, and gain
-        self.correction = (self.avg_error / 1000000) * self.fb_direction * self.fb_gain
-        # correction to PV for logging
-        self.correction_pv.put(value=(self.correction * 1000000), timeout=1.0)
+        self.fb_direction = self.params.get('fb_direction')
+        self.fb_gain = self.params.get('fb_gain')
+        self.on_off = self.params.get('on_off')
+        # scale to ns, direction, and gain, weighted by the confidence of a partial fill
+        self.correction = (self.avg_error / 1000000) * self.fb_direction * self.fb_gain * self.fill_weight
+        self.correction_count += 1
         self.atm_fb = self.atm_fb + self.correction  # update ATM FB
         # only write if drift correction enabled and <1 ps
-        if (self.on_off == 1) and ((abs(self.correction) < 0.001)):
+        applied = (self.on_off == 1) and ((abs(self.correction) < 0.001))
+        if applied:
+            # expected effect of the write on the measured error, fb_direction * 1e6 fs per ns
+            shift = -self.fb_direction * self.correction * 1000000
+            self.kalman.shift(shift)
+            self.gate.shift(shift)
+            self.loop_offset -= shift
+            if self.spectrum is not None:
+                self.spectrum.add_correction(self.atm_err_stamps[-1], -shift)
+        return applied
+
+    def publish_puts(self):
+        """(pv, value) updates of the averages and the correction"""
+        puts = [(self.ampl_pv, self.avg_ampl),
+                (self.fwhm_pv, self.avg_fwhm),
+                (self.avg_pos_error, self.avg_error),  # average error
+                (self.correction_pv, self.correction * 1000000)]  # correction for logging
+        self.update_acceptance()
+        if self.acceptance_pv is not None:
+            puts.append((self.acceptance_pv, self.acceptance))
+        if (self.drift_rate_pv is not None) and (self.avg_mode == 4):
+            puts.append((self.drift_rate_pv, self.kalman.rate))
+        return puts
+
+    def end_cycle(self, applied):
+        """records the correction and closes the timing cycle"""
+        if self.recorder is not None:
+            self.recorder.record_correction(self.clock(), self.avg_error, self.correction, self.atm_fb, applied)
+        self.timer.end_cycle()
+        self.publish_due()
+
+    def tune_limits(self):
+        """proposes filter limits from the tuner and, in apply mode, writes them to the limit PVs"""
+        self.auto_limits_tuned = time.monotonic()
+        self.proposed_limits = self.tuner.limits(self.limits)
+        if not self.proposed_limits:
+            return  # too few frames in the window
+        if self.auto_limits_pv is not None:
+            self.auto_limits_pv.put(value=[self.proposed_limits.get(name, float('nan')) for name in FILTER_LIMITS],
+                                    timeout=1.0)
+        if (self.auto_limits == 'apply'):
+            for name, value in self.proposed_limits.items():
+                getattr(self, name + '_pv').put(value=value, timeout=1.0)  # the monitors update the cache
+            print("[INFO] Auto limits: " + ", ".join(f"{name} {value:.4g}"
+                                                      for name, value in self.proposed_limits.items()))
+
+    def publish_due(self):
+        """publishes the metrics once per metrics_interval, tunes the limits once per auto_limit_interval"""
+        if (time.monotonic() - self.metrics_published > self.metrics_interval):
+            self.publish_metrics()
+        if (self.tuner is not None) and (time.monotonic() - self.auto_limits_tuned > self.auto_limit_interval):
+            self.tune_limits()
+
+    def correct(self):
+        """filters data and applies correction"""
+        self.timer.start()
+        self.check_hutch()
+        # === Update values ===
+        # get current ATM FB hook value
+        self.atm_fb = self.atm_fb_pv.get(timeout=60.0)
+        self.timer.lap('actuate')
+        self.start_fill()
+        self.timer.lap('filter')
+        # ============== loop for filling sample ======================
+        while not self.fill_from_pending():
+            self.timer.lap('average')
+            # get current PV values
+            try:
+                self.pull_atm_values()
+            except cycle_deadline_reached:
+                self.partial_fill()  # correct from the partial buffer or re-raise
+                break
+            self.timer.lap('acquire')
+            # update tracking PVs
+            for pv, value in self.tracking_puts():
+                pv.put(value=value, timeout=1.0)
+            self.filter_batch()
+            # update filter state
+            for pv, value in self.filter_puts():
+                pv.put(value=value, timeout=1.0)
+            self.timer.lap('filter')
+        # ============= averaging ===============
+        if not self.average():
+            return
+        self.timer.lap('average')
+        # ======= updates PVs & apply correction =================
+        applied = self.compute_correction()
+        for pv, value in self.publish_puts():
+            pv.put(value=value, timeout=1.0)
+        self.timer.lap('publish')
+        if applied:
             self.atm_fb_pv.put(value=self.atm_fb, timeout=1.0)
+            self.applied_stamp = self.clock()
         else:
             pass
+        self.timer.lap('actuate')
+        self.end_cycle(applied)
+
+
+def sim_seed(backend, config_path, ttall_rate=120.0, overrides=None):
+    """seeds a simulated backend with working settings and a closed-loop timetool for one config"""
+    with open(config_path, 'r') as file:
+        hutch_config = json.load(file)
+    hutch_config.update(overrides or {})
+    for key, value in SIM_DEFAULTS.items():
+        backend.write(hutch_config[key], value)
+    atm_fb_pv = hutch_config.get('atm_fb_pv') or ATM_FB_PV
+    backend.write(hutch_config.get('on_off_pv') or ON_OFF_PV, 1)
+    backend.write(atm_fb_pv, 0.0)
+    if ttall_rate:  # every timetool of the config sees the same timing, in its own layout
+        backend.script_waveform(hutch_config['ttall_pv'],
+                                sim_timetool(backend, atm_fb_pv, fields=hutch_config.get('ttall_fields')), ttall_rate)
+        for source in hutch_config.get('ttall_sources', []):
+            backend.script_waveform(source['pv'], sim_timetool(backend, atm_fb_pv, fields=source.get('fields')),
+                                    ttall_rate)
+
+
+def sim_backend_for(config_dir, hutch_selector=0, ttall_rate=120.0, **kw):
+    """simulated backend seeded with working settings and a closed-loop timetool
+
+    With ttall_rate None no timetool is scripted and the caller feeds TTALL.
+    """
+    config_file = 'qrixs_atm_fb.json' if (hutch_selector == 1) else 'crixs_atm_fb.json'
+    backend = sim_backend({HUTCH_SELECTOR_PV: hutch_selector}, **kw)
+    sim_seed(backend, os.path.join(config_dir, config_file), ttall_rate)
+    return backend
+
+
+class hutch_switcher():
+    """keeps a connected drift_correction per hutch and swaps the active one on a hutch change
+
+    Both configs are loaded and all their channels connected and monitored
+    at startup, so a switch is an in-memory swap plus an estimator reset
+    instead of a re-read of the config and a reconnect.
+    """
+    def __init__(self, backend=None, config_dir=CONFIG_DIR, factory=drift_correction):
+        backend = psp_backend() if backend is None else backend
+        self.corrections = {selector: factory(backend, config_dir, hutch_selector=selector) for selector in (0, 1)}
+        self.active = self.corrections[0]
+        self.switch()
+
+    def switch(self):
+        """activates the correction for the current hutch selector, returns it"""
+        start = time.perf_counter()
+        hutch_selector = self.active.params.get('hutch_selector')
+        self.active = self.corrections[1 if (hutch_selector == 1) else 0]  # qRIXS or cRIXS
+        self.active.hutch_selector = hutch_selector
+        self.active.reset()
+        print(f"[INFO] Active hutch config {self.active.config} ({(time.perf_counter() - start) * 1000:.2f} ms)")
+        return self.active
+
+    def close(self):
+        """stops the PV monitors of both hutches"""
+        for correction in self.corrections.values():
+            correction.close()
 
 
-def run():
+def run(backend=None, config_dir=CONFIG_DIR, hot_switch=False):
     # print(f"Hello world!")
     print(f"Drift correction script started at {time.strftime('%Y-%m-%d %H:%M:%S')}")
-    correction = drift_correction()  # initialize
+    switcher = None
+    if hot_switch:  # both hutches connected, switched in memory
+        switcher = hutch_switcher(backend, config_dir)
+        correction = switcher.active
+    else:
+        correction = drift_correction(backend, config_dir)  # initialize
     heartbeat_counter = 0
     try:
         while True:
@@ -267,15 +945,18 @@ def run():
                 heartbeat_counter += 1
                 correction.heartbeat_pv.put(value=heartbeat_counter, timeout=1.0)
                 correction.correct()
-                time.sleep(0.1)
+                time.sleep(correction.cycle_sleep)
+            except cycle_deadline_reached:
+                # too few samples by the deadline, go round again without a correction
+                correction.end_deadline_cycle()
             except hutch_selection_changed:
                 print("[INFO] Hutch selection changed.")
-                correction = drift_correction()  # re-initialize
+                if switcher is not None:
+                    correction = switcher.switch()
+                else:
+                    correction.close()
+                    correction = drift_correction(backend, config_dir)  # re-initialize
                 correction.atm_fb_pv.put(value=0, timeout=1.0)
-            except buffer_fill_timeout:
-                print("[INFO] filter timeout.")
-                # Short pause before retrying
-                time.sleep(1.0)
             except Exception as e:
                 print(f"[ERROR] Unexpected error: {e}")
                 time.sleep(1.0)  # Prevent rapid error loops
@@ -284,4 +965,15 @@ def run():
 
 
 if __name__ == "__main__":
-    run()
+    args = ((), {})
+    if '--sim' in sys.argv[1:]:  # simulated PVs, configs from this directory
+        sim_dir = os.path.dirname(os.path.abspath(__file__))
+        args = ((sim_backend_for(sim_dir), sim_dir), {})
+    if '--hot-switch' in sys.argv[1:]:  # keep both hutch configs connected
+        args[1]['hot_switch'] = True
+    if '--async' in sys.argv[1:]:  # concurrent PV I/O on an asyncio loop
+        import asyncio
+        from drift_correction_async import run_async
+        asyncio.run(run_async(*args[0], **args[1]))
+    else:
+        run(*args[0], **args[1])
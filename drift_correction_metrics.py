@@ -0,0 +1,121 @@
+# drift_correction_metrics.py
+import bisect
+import math
+import os
+import time
+
+PHASES = ('acquire', 'filter', 'average', 'publish', 'actuate')
+
+
+class phase_timer():
+    """per-phase cycle timings in log-binned histograms over a rolling window
+
+    start() opens a cycle, lap(phase) charges the time since the previous
+    mark to a phase (phases may repeat within a cycle) and end_cycle()
+    adds the cycle's per-phase totals to the histograms. The histograms
+    cover the time since the last reset(), normally one publish interval.
+    The period between consecutive end_cycle() calls goes into its own
+    histogram; its standard deviation is the cycle jitter.
+    """
+    def __init__(self, phases=PHASES, min_s=1e-6, max_s=100.0, bins_per_decade=20):
+        self.phases = phases
+        decades = math.log10(max_s / min_s)
+        n_edges = int(round(decades * bins_per_decade)) + 1
+        self.edges = [min_s * 10 ** (i / bins_per_decade) for i in range(n_edges)]
+        self.mark = time.perf_counter()
+        self.cycle = dict.fromkeys(phases, 0.0)
+        self.last_end = None  # end of the previous cycle
+        self.reset()
+
+    def reset(self):
+        """starts a new histogram window"""
+        self.counts = {phase: [0] * (len(self.edges) + 1) for phase in self.phases + ('period',)}
+        self.totals = dict.fromkeys(self.phases + ('period',), 0.0)
+        self.maxima = dict.fromkeys(self.phases + ('period',), 0.0)
+        self.cycles = 0
+        self.periods = 0
+        self.period_squares = 0.0
+        self.window_start = time.monotonic()
+
+    def start(self):
+        """opens a cycle, discarding laps of an unfinished one"""
+        for phase in self.phases:
+            self.cycle[phase] = 0.0
+        self.mark = time.perf_counter()
+
+    def lap(self, phase):
+        """charges the time since the last mark to phase"""
+        now = time.perf_counter()
+        self.cycle[phase] += now - self.mark
+        self.mark = now
+
+    def add(self, phase, seconds):
+        """adds one timing to the histogram of phase"""
+        self.counts[phase][bisect.bisect_right(self.edges, seconds)] += 1
+        self.totals[phase] += seconds
+        if seconds > self.maxima[phase]:
+            self.maxima[phase] = seconds
+
+    def end_cycle(self):
+        """adds the finished cycle and its period to the histograms"""
+        for phase, seconds in self.cycle.items():
+            self.add(phase, seconds)
+        self.cycles += 1
+        now = time.perf_counter()
+        if self.last_end is not None:
+            period = now - self.last_end
+            self.add('period', period)
+            self.periods += 1
+            self.period_squares += period * period
+        self.last_end = now
+
+    def quantile(self, phase, q):
+        """upper edge of the histogram bin holding quantile q, in seconds"""
+        total = sum(self.counts[phase])
+        if total == 0:
+            return 0.0
+        target = q * total
+        seen = 0
+        for i, count in enumerate(self.counts[phase]):
+            seen += count
+            if seen >= target:
+                break
+        return min(self.edges[min(i, len(self.edges) - 1)], self.maxima[phase])
+
+    def snapshot(self):
+        """per-phase mean, p50, p99 and max over the window, in seconds"""
+        return {phase: {
+            'mean': self.totals[phase] / self.cycles if self.cycles else 0.0,
+            'p50': self.quantile(phase, 0.5),
+            'p99': self.quantile(phase, 0.99),
+            'max': self.maxima[phase],
+        } for phase in self.phases}
+
+    def period_snapshot(self):
+        """cycle period mean, jitter (standard deviation), p99 and max over the window, in seconds"""
+        mean = self.totals['period'] / self.periods if self.periods else 0.0
+        variance = self.period_squares / self.periods - mean * mean if self.periods else 0.0
+        return {
+            'mean': mean,
+            'jitter': math.sqrt(max(variance, 0.0)),
+            'p99': self.quantile('period', 0.99),
+            'max': self.maxima['period'],
+        }
+
+
+def write_metrics_file(path, timer, extra=None):
+    """writes a snapshot as text metrics, replacing the file atomically"""
+    lines = [f"# drift correction metrics, {time.strftime('%Y-%m-%d %H:%M:%S')}, "
+             f"window {time.monotonic() - timer.window_start:.1f} s",
+             f"drift_correction_cycles {timer.cycles}"]
+    for phase, stats in timer.snapshot().items():
+        for stat, value in stats.items():
+            lines.append(f'drift_correction_phase_seconds{{phase="{phase}",stat="{stat}"}} {value:.6g}')
+    for stat, value in timer.period_snapshot().items():
+        lines.append(f'drift_correction_cycle_period_seconds{{stat="{stat}"}} {value:.6g}')
+    for name, value in (extra or {}).items():
+        lines.append(f"drift_correction_{name} {value}")
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
@@ -0,0 +1,694 @@
+# drift_correction_pv.py
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+EPICS_EPOCH = 631152000  # seconds from 1970-01-01 to 1990-01-01
+
+
+class frame_timeout(Exception):
+    """Raised when no timetool frame arrives within the allowed time."""
+    pass
+
+
+class sim_timeout(Exception):
+    """Raised by a simulated channel that is disconnected or too slow."""
+    pass
+
+
+def pv_stamp(pv):
+    """returns the EPICS timestamp of the latest PV value in POSIX seconds"""
+    try:
+        secs, nsec = pv.timestamp()
+    except Exception:
+        return time.time()
+    if not secs:  # no timestamp from the IOC yet
+        return time.time()
+    return secs + EPICS_EPOCH + nsec * 1e-9
+
+
+class frame_queue():
+    """bounded single-producer/single-consumer queue of TTALL frames
+
+    Frames are copied into preallocated arrays. Only the producer moves
+    tail and only the consumer moves head, so neither side takes a lock
+    and a slow consumer never stalls ingest. A frame arriving at a full
+    queue is dropped and counted; overflows counts the times the queue
+    ran full and high_water the deepest it has been. Queues of several
+    sources can share one ready event, see wait_any().
+    """
+    def __init__(self, capacity=1000, ready=None):
+        self.capacity = int(capacity)
+        self.size = self.capacity + 1  # one free slot tells full from empty
+        self.stamps = np.zeros(self.size)
+        self.frames = None  # (size, fields), allocated with the first frame
+        self.head = 0  # next slot to read, consumer side
+        self.tail = 0  # next slot to write, producer side
+        self.ready = threading.Event() if ready is None else ready
+        # producer side counters
+        self.received = 0  # frames offered to the queue
+        self.dropped = 0  # frames lost to a full queue
+        self.overflows = 0  # times the queue ran full
+        self.high_water = 0  # deepest queue seen
+        self.full = False
+
+    def __len__(self):
+        return (self.tail - self.head) % self.size
+
+    def push(self, stamp, values):
+        """producer: queues one frame, False if it was dropped"""
+        self.received += 1
+        tail = self.tail
+        next_tail = (tail + 1) % self.size
+        if next_tail == self.head:
+            self.dropped += 1
+            if not self.full:
+                self.overflows += 1
+                self.full = True
+            return False
+        self.full = False
+        if self.frames is None:
+            self.frames = np.full((self.size, len(values)), np.nan)
+        n = min(len(values), self.frames.shape[1])
+        self.frames[tail, :n] = values[:n]
+        self.frames[tail, n:] = np.nan  # a short frame must not show the slot's earlier values
+        self.stamps[tail] = stamp
+        self.tail = next_tail  # publishes the slot to the consumer
+        depth = (next_tail - self.head) % self.size
+        if depth > self.high_water:
+            self.high_water = depth
+        self.ready.set()
+        return True
+
+    def wait(self, timeout):
+        """consumer: waits up to timeout for a queued frame"""
+        if self.tail != self.head:
+            return True
+        self.ready.clear()
+        if self.tail != self.head:  # pushed before the clear
+            return True
+        return self.ready.wait(timeout)
+
+    def clear(self):
+        """consumer: discards every queued frame"""
+        self.head = self.tail
+
+    def pop_all(self, timeout=60.0):
+        """consumer: (stamps, frames) of every queued frame, waiting up to timeout for one"""
+        if not self.wait(timeout):
+            raise frame_timeout
+        head, tail = self.head, self.tail
+        if head < tail:
+            stamps = self.stamps[head:tail].copy()
+            frames = self.frames[head:tail].copy()
+        else:  # wrapped
+            stamps = np.concatenate((self.stamps[head:], self.stamps[:tail]))
+            frames = np.concatenate((self.frames[head:], self.frames[:tail]))
+        self.head = tail  # frees the slots for the producer
+        return stamps, frames
+
+
+def wait_any(queues, ready, timeout):
+    """consumer: waits up to timeout until one of the queues sharing ready holds a frame"""
+    if any(len(queue) for queue in queues):
+        return
+    ready.clear()
+    if any(len(queue) for queue in queues):  # pushed before the clear
+        return
+    if not ready.wait(timeout):
+        raise frame_timeout
+
+
+class ttall_monitor():
+    """feeds every TTALL update from a CA monitor into a frame_queue
+
+    The monitor callback runs on the CA client thread, which is the
+    acquisition thread; the correction loop consumes the queue on its own
+    thread, so CA put latency in the loop does not hold up ingest.
+    """
+    def __init__(self, pv, queue_size=1000, ready=None):
+        self.pv = pv
+        self.queue = frame_queue(queue_size, ready)
+        self.last_stamp = None
+        self.cb_id = None
+
+    @property
+    def received(self):
+        """frames delivered by the monitor"""
+        return self.queue.received
+
+    @property
+    def dropped(self):
+        """frames lost because the loop fell behind"""
+        return self.queue.dropped
+
+    def start(self, timeout=5.0):
+        """connects the TTALL PV and subscribes to updates"""
+        self.pv.connect(timeout=timeout)
+        self.cb_id = self.pv.add_monitor_callback(self.on_update)
+        self.pv.monitor_start()
+
+    def stop(self):
+        """unsubscribes from the TTALL PV"""
+        if self.cb_id is not None:
+            self.pv.del_monitor_callback(self.cb_id)
+            self.pv.monitor_stop()
+            self.cb_id = None
+
+    def on_update(self, exception=None):
+        """monitor callback, runs on the CA thread"""
+        if exception is not None:
+            return
+        stamp = pv_stamp(self.pv)
+        if stamp == self.last_stamp:  # same frame delivered twice
+            return
+        self.last_stamp = stamp
+        self.queue.push(stamp, np.asarray(self.pv.value, dtype=float))  # copied out of the CA buffer
+
+    def drain(self, timeout=60.0):
+        """(stamps, frames) of every queued frame, waiting up to timeout for at least one"""
+        return self.queue.pop_all(timeout)
+
+    def clear(self):
+        """discards queued frames"""
+        self.queue.clear()
+
+
+class param_cache():
+    """serves the latest values of monitored control PVs from memory"""
+    def __init__(self, pvs):
+        self.pvs = dict(pvs)  # parameter name -> Pv
+        self.values = {}
+        self.versions = dict.fromkeys(self.pvs, 0)  # per-parameter change count
+        self.version = 0  # total change count over all parameters
+        self.lock = threading.Condition()
+        self.cb_ids = {}
+
+    def start(self, timeout=1.0):
+        """subscribes to updates, seeded by the initial monitor updates
+
+        Parameters without an initial update within timeout are seeded
+        with a get.
+        """
+        for name, pv in self.pvs.items():
+            self.cb_ids[name] = pv.add_monitor_callback(
+                lambda exception=None, name=name: self.on_update(name, exception))
+            pv.monitor_start()
+        with self.lock:
+            self.lock.wait_for(lambda: len(self.values) == len(self.pvs), timeout)
+            missing = [name for name in self.pvs if name not in self.values]
+        for name in missing:
+            value = self.pvs[name].get(timeout=timeout)
+            with self.lock:
+                self.values.setdefault(name, value)
+
+    def stop(self):
+        """unsubscribes from all parameter PVs"""
+        for name, cb_id in self.cb_ids.items():
+            self.pvs[name].del_monitor_callback(cb_id)
+            self.pvs[name].monitor_stop()
+        self.cb_ids = {}
+
+    def on_update(self, name, exception=None):
+        """monitor callback, runs on the CA thread"""
+        if exception is not None:
+            return
+        value = self.pvs[name].value
+        with self.lock:
+            if (name not in self.values) or (value != self.values[name]):
+                self.values[name] = value
+                self.versions[name] += 1
+                self.version += 1
+                self.lock.notify_all()
+
+    def get(self, name):
+        """latest value of a parameter, no CA traffic"""
+        return self.values[name]
+
+    def version_of(self, *names):
+        """change count over a group of parameters"""
+        return sum(self.versions[name] for name in names)
+
+
+class motion_tracker():
+    """tracks stage motion from monitors of its readback and motor status
+
+    Motion is kept as a short history of [start, end] intervals in PV
+    timestamp seconds. A readback change of at least `resolution` marks
+    the update time as moving; DMOV = 0 or MOVN = 1 opens an interval
+    and DMOV = 1 or MOVN = 0 closes it. Frames stamped within `settle`
+    seconds after an interval are still counted as moving.
+    """
+    def __init__(self, readback_pv, dmov_pv=None, movn_pv=None, settle=0.5, resolution=0.1, history=64):
+        self.readback_pv = readback_pv
+        self.status_pvs = {'dmov': dmov_pv, 'movn': movn_pv}
+        self.settle = settle
+        self.resolution = resolution
+        self.intervals = deque(maxlen=history)  # [start, end] pairs, end None while moving
+        self.position = None
+        self.lock = threading.Lock()
+        self.cb_ids = []
+
+    def start(self, timeout=1.0):
+        """seeds the readback with one get and subscribes to readback and status"""
+        self.position = self.readback_pv.get(timeout=timeout)
+        self.subscribe(self.readback_pv, self.on_readback)
+        for name, pv in self.status_pvs.items():
+            if pv is not None:
+                pv.connect(timeout=timeout)
+                self.subscribe(pv, lambda exception=None, name=name: self.on_status(name, exception))
+
+    def subscribe(self, pv, callback):
+        """adds a monitor callback and starts the monitor"""
+        self.cb_ids.append((pv, pv.add_monitor_callback(callback)))
+        pv.monitor_start()
+
+    def stop(self):
+        """unsubscribes from all PVs"""
+        for pv, cb_id in self.cb_ids:
+            pv.del_monitor_callback(cb_id)
+            pv.monitor_stop()
+        self.cb_ids = []
+
+    def on_readback(self, exception=None):
+        """readback monitor callback, runs on the CA thread"""
+        if exception is not None:
+            return
+        value = self.readback_pv.value
+        if (self.position is not None) and (abs(value - self.position) < self.resolution):
+            return
+        self.position = value
+        self.moved(pv_stamp(self.readback_pv))
+
+    def on_status(self, name, exception=None):
+        """DMOV/MOVN monitor callback, runs on the CA thread"""
+        if exception is not None:
+            return
+        pv = self.status_pvs[name]
+        moving = (pv.value == 0) if (name == 'dmov') else (pv.value != 0)
+        stamp = pv_stamp(pv)
+        with self.lock:
+            last = self.intervals[-1] if self.intervals else None
+            if moving and ((last is None) or (last[1] is not None)):
+                self.intervals.append([stamp, None])
+            elif (not moving) and (last is not None) and (last[1] is None):
+                last[1] = stamp
+
+    def moved(self, stamp):
+        """marks the stage as moving at stamp, merging with an interval still settling"""
+        with self.lock:
+            last = self.intervals[-1] if self.intervals else None
+            if (last is not None) and ((last[1] is None) or (stamp <= last[1] + self.settle)):
+                if last[1] is not None:
+                    last[1] = max(last[1], stamp)
+            else:
+                self.intervals.append([stamp, stamp])
+
+    def moving_mask(self, stamps):
+        """per-frame bool array, True for frames stamped during motion or its settle window"""
+        stamps = np.asarray(stamps, dtype=float)
+        mask = np.zeros(len(stamps), dtype=bool)
+        if len(stamps) == 0:
+            return mask
+        first = stamps.min()
+        with self.lock:
+            intervals = [tuple(interval) for interval in reversed(self.intervals)]
+        for start, end in intervals:  # newest first
+            if end is None:
+                mask |= (stamps >= start)
+            elif (end + self.settle < first):  # this and all older intervals precede the batch
+                break
+            else:
+                mask |= (stamps >= start) & (stamps <= end + self.settle)
+        return mask
+
+
+class shared_pv():
+    """one user's handle on a registry channel
+
+    Reads, writes and callbacks go straight to the shared channel; the
+    channel's monitor runs while at least one handle has it started.
+    """
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.channel = registry.channels[name]
+        self.monitoring = False
+        self.callbacks = {}  # this handle's callbacks by id
+
+    @property
+    def value(self):
+        return self.channel.value
+
+    @property
+    def isconnected(self):
+        return self.channel.isconnected
+
+    def connect(self, timeout=None):
+        self.registry.connect(self.name, timeout)
+
+    def get(self, *args, **kw):
+        return self.channel.get(*args, **kw)
+
+    def put(self, value, *args, **kw):
+        return self.channel.put(value, *args, **kw)
+
+    def timestamp(self):
+        return self.channel.timestamp()
+
+    def add_monitor_callback(self, fn, once=False):
+        cb_id = self.channel.add_monitor_callback(fn, once)
+        self.callbacks[cb_id] = fn
+        return cb_id
+
+    def del_monitor_callback(self, cb_id):
+        self.callbacks.pop(cb_id, None)
+        self.channel.del_monitor_callback(cb_id)
+
+    def monitor_start(self, monitor_append=False):
+        if not self.monitoring:
+            self.monitoring = True
+            if not self.registry.monitor_start(self.name) and (self.channel.value is not None):
+                for fn in list(self.callbacks.values()):  # initial update, as a new subscription gets
+                    fn(None)
+
+    def monitor_stop(self):
+        if self.monitoring:
+            self.monitoring = False
+            self.registry.monitor_stop(self.name)
+
+
+class pv_registry():
+    """deduplicates channels by name and connects them in parallel
+
+    pv(name) hands out a shared_pv on the one channel kept per name, so
+    configs and instances naming the same PV share its connection and
+    monitor. connect_all() connects every new channel concurrently on a
+    thread pool and records the connect latency of each.
+    """
+    def __init__(self, factory, attach=None, max_workers=32):
+        self.factory = factory  # name -> channel
+        self.attach = attach  # thread initializer, joins the CA context
+        self.max_workers = max_workers
+        self.channels = {}
+        self.connect_seconds = {}  # name -> connect latency
+        self.errors = {}  # name -> last connect error
+        self.monitor_users = Counter()
+        self.lock = threading.Lock()
+
+    def pv(self, name):
+        """new handle on the channel for name, creating the channel once"""
+        with self.lock:
+            if name not in self.channels:
+                self.channels[name] = self.factory(name)
+        return shared_pv(self, name)
+
+    def connect(self, name, timeout=None):
+        """connects one channel unless it already is, recording the latency"""
+        channel = self.channels[name]
+        if getattr(channel, 'isconnected', False):
+            return
+        start = time.perf_counter()
+        try:
+            channel.connect(timeout=timeout)
+        except Exception as e:
+            self.errors[name] = str(e) or type(e).__name__
+            raise
+        self.connect_seconds[name] = time.perf_counter() - start
+        self.errors.pop(name, None)
+
+    def connect_all(self, timeout=1.0):
+        """connects every unconnected channel in parallel, returns (seconds, names tried)"""
+        names = [name for name, channel in list(self.channels.items())
+                 if not getattr(channel, 'isconnected', False)]
+        start = time.perf_counter()
+        if names:
+            with ThreadPoolExecutor(max_workers=min(len(names), self.max_workers),
+                                    initializer=self.attach) as executor:
+                for future in [executor.submit(self.connect, name, timeout) for name in names]:
+                    try:
+                        future.result()
+                    except Exception:
+                        pass  # kept in errors, the first get raises again
+        return time.perf_counter() - start, names
+
+    def monitor_start(self, name):
+        """starts the channel monitor for its first user, True if it was started"""
+        with self.lock:
+            self.monitor_users[name] += 1
+            first = self.monitor_users[name] == 1
+        if first:
+            self.channels[name].monitor_start()
+        return first
+
+    def monitor_stop(self, name):
+        """stops the channel monitor when its last user stops"""
+        with self.lock:
+            self.monitor_users[name] -= 1
+            last = self.monitor_users[name] == 0
+        if last:
+            self.channels[name].monitor_stop()
+
+    def state(self):
+        """per-channel connection state and connect latency (ms)"""
+        return {name: {
+            'connected': bool(getattr(channel, 'isconnected', False)),
+            'connect_ms': self.connect_seconds[name] * 1000 if name in self.connect_seconds else None,
+            'error': self.errors.get(name),
+        } for name, channel in self.channels.items()}
+
+    def report(self, seconds, names, slowest=3):
+        """one-line startup summary of a connect_all() plus the slowest and failed channels"""
+        failed = [name for name in names if name in self.errors]
+        lines = [f"[INFO] {len(names)} new of {len(self.channels)} channels connected in parallel "
+                 f"in {seconds * 1000:.1f} ms, {len(failed)} failed"]
+        times = sorted(((self.connect_seconds[name], name) for name in names if name in self.connect_seconds),
+                       reverse=True)
+        if times:
+            lines.append("[INFO] slowest: " + ", ".join(f"{name} {t * 1000:.1f} ms" for t, name in times[:slowest]))
+        for name in failed:
+            lines.append(f"[ERROR] {name} did not connect: {self.errors[name]}")
+        return lines
+
+
+class psp_backend():
+    """PV backend on the psp Channel Access bindings
+
+    All instances share one process-wide pv_registry.
+    """
+    registry = None
+
+    def __init__(self):
+        from psp.Pv import Pv  # only needed on the controls network
+        self.pv_class = Pv
+        if psp_backend.registry is None:
+            psp_backend.registry = pv_registry(Pv, self.attach_thread)
+
+    def pv(self, name):
+        """channel with connect/get/put/monitor, a handle on a shared psp Pv"""
+        return self.registry.pv(name)
+
+    def connect_all(self, timeout=1.0):
+        return self.registry.connect_all(timeout)
+
+    def attach_thread(self):
+        """joins a worker thread to the process CA context"""
+        import pyca
+        pyca.attach_context()
+
+
+class sim_pv():
+    """simulated channel with the subset of the psp Pv interface the loop uses"""
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+        self.value = None
+        self.secs = 0
+        self.nsec = 0
+        self.isconnected = False
+        self.callbacks = {}
+        self.next_cb_id = 0
+        self.monitoring = False
+
+    def connect(self, timeout=None):
+        self.backend.operation('connect', self.name, timeout)
+        self.isconnected = True
+
+    def get(self, timeout=None):
+        self.backend.operation('get', self.name, timeout)
+        self.isconnected = True
+        self.update(*self.backend.read(self.name))
+        return self.value
+
+    def put(self, value, timeout=None):
+        self.backend.operation('put', self.name, timeout)
+        self.backend.write(self.name, value)
+
+    def timestamp(self):
+        return (self.secs, self.nsec)
+
+    def add_monitor_callback(self, fn, once=False):
+        self.next_cb_id += 1
+        self.callbacks[self.next_cb_id] = fn
+        return self.next_cb_id
+
+    def del_monitor_callback(self, cb_id):
+        self.callbacks.pop(cb_id, None)
+
+    def monitor_start(self, monitor_append=False):
+        with self.backend.lock:  # a CA subscription does not wait for the IOC
+            self.backend.ops['monitor'] += 1
+        self.monitoring = True
+        if self.name in self.backend.values:  # initial value, as CA does
+            self.notify(*self.backend.read(self.name))
+
+    def monitor_stop(self):
+        self.monitoring = False
+
+    def update(self, value, stamp):
+        self.value = value
+        self.secs = int(stamp - EPICS_EPOCH)
+        self.nsec = int(round((stamp - EPICS_EPOCH - self.secs) * 1e9))
+
+    def notify(self, value, stamp):
+        """delivers a monitor update"""
+        if not self.monitoring:
+            return
+        self.update(value, stamp)
+        for fn in list(self.callbacks.values()):
+            fn(None)
+
+
+class sim_backend():
+    """in-process EPICS stand-in with configurable latency, jitter and disconnects
+
+    values seeds the PV values by name. Every operation sleeps latency plus
+    a uniform random jitter; an operation slower than its timeout, on a
+    disconnected channel, or hit by disconnect_rate (probability per
+    operation) waits out its timeout and raises sim_timeout. ops counts
+    operations by kind.
+    """
+    def __init__(self, values=None, latency=0.0, jitter=0.0, disconnect_rate=0.0, seed=None):
+        self.values = {name: (value, time.time()) for name, value in (values or {}).items()}
+        self.latency = latency
+        self.jitter = jitter
+        self.disconnect_rate = disconnect_rate
+        self.rng = random.Random(seed)
+        self.channels = {}  # name -> list of sim_pv
+        self.down_until = {}  # name -> time a scripted disconnect ends
+        self.ops = Counter()
+        self.lock = threading.Lock()
+        self.running = True
+        self.threads = []
+        self.registry = pv_registry(self.channel, self.attach_thread)
+
+    def channel(self, name):
+        channel = sim_pv(self, name)
+        with self.lock:
+            self.channels.setdefault(name, []).append(channel)
+        return channel
+
+    def pv(self, name):
+        return self.registry.pv(name)
+
+    def connect_all(self, timeout=1.0):
+        return self.registry.connect_all(timeout)
+
+    def attach_thread(self):
+        pass
+
+    def is_down(self, name):
+        return time.time() < self.down_until.get(name, 0.0)
+
+    def operation(self, kind, name, timeout):
+        """applies latency, jitter and disconnects to one channel operation"""
+        with self.lock:
+            self.ops[kind] += 1
+            delay = self.latency + self.jitter * self.rng.random()
+            dropped = self.disconnect_rate and self.rng.random() < self.disconnect_rate
+        if dropped or self.is_down(name) or (timeout is not None and delay > timeout):
+            time.sleep(timeout or 0.0)
+            raise sim_timeout(f"{kind} {name} timed out")
+        if delay > 0:
+            time.sleep(delay)
+
+    def read(self, name):
+        return self.values.get(name, (0.0, time.time()))
+
+    def write(self, name, value, stamp=None):
+        """sets a PV value and fires its monitors"""
+        stamp = time.time() if stamp is None else stamp
+        self.values[name] = (value, stamp)
+        if self.is_down(name):
+            return
+        for channel in list(self.channels.get(name, ())):
+            channel.notify(value, stamp)
+
+    def disconnect(self, name, duration):
+        """takes a channel down for duration seconds"""
+        self.down_until[name] = time.time() + duration
+
+    def script_waveform(self, name, source, rate):
+        """publishes frames from source at rate Hz on a background thread
+
+        source is an iterable of arrays (e.g. recorded frames) or a
+        callable taking the elapsed time in seconds and returning one.
+        """
+        thread = threading.Thread(target=self.publish, args=(name, source, rate), daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def publish(self, name, source, rate):
+        period = 1.0 / rate
+        frames = None if callable(source) else iter(source)
+        start = time.time()
+        tick = 0
+        while self.running:
+            tick += 1
+            time.sleep(max(start + tick * period - time.time(), 0.0))
+            if frames is None:
+                frame = source(tick * period)
+            else:
+                frame = next(frames, None)
+                if frame is None:
+                    return
+            self.write(name, np.asarray(frame, dtype=float))
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class sim_timetool():
+    """closed-loop TTALL frame source for sim_backend.script_waveform
+
+    The measured position is a linear drift plus Gaussian jitter minus
+    the correction currently applied on the feedback PV, so corrections
+    written by the loop feed back into later frames. fields maps pos_ps,
+    ampl and fwhm to frame indices (standard layout 1, 2, 5).
+    """
+    def __init__(self, backend, fb_pv, drift_fs_per_s=2.0, jitter_fs=30.0,
+                 ampl=0.05, fwhm=100.0, length=8, seed=None, fields=None):
+        self.backend = backend
+        self.fb_pv = fb_pv
+        self.drift_fs_per_s = drift_fs_per_s
+        self.jitter_fs = jitter_fs
+        self.ampl = ampl
+        self.fwhm = fwhm
+        self.length = length
+        self.fields = dict({'pos_ps': 1, 'ampl': 2, 'fwhm': 5}, **(fields or {}))
+        self.rng = np.random.default_rng(seed)
+
+    def __call__(self, t):
+        atm_fb = self.backend.read(self.fb_pv)[0]  # ns
+        frame = np.zeros(self.length)
+        pos_fs = self.drift_fs_per_s * t + self.rng.normal(0.0, self.jitter_fs) - atm_fb * 1000000
+        frame[self.fields['pos_ps']] = pos_fs / 1000
+        frame[self.fields['ampl']] = self.ampl * (1 + 0.1 * self.rng.normal())
+        frame[self.fields['fwhm']] = self.fwhm * (1 + 0.1 * self.rng.normal())
+        return frame
@@ -0,0 +1,137 @@
+# drift_correction_recorder.py
+import glob
+import os
+import re
+import time
+import numpy as np
+
+RECORD_FRAME = 0  # one raw TTALL frame and its filter decision
+RECORD_CORRECTION = 1  # one correction cycle
+FLAG_APPLIED = 1  # correction record: ATM FB was written
+
+
+def record_dtype(fields=16):
+    """fixed record layout; atm_err holds the first `fields` TTALL values"""
+    return np.dtype([
+        ('kind', 'u1'),
+        ('flags', 'u1'),
+        ('filter_mask', 'u2'),
+        ('n_fields', 'u2'),
+        ('stamp', 'f8'),  # POSIX seconds, 0 marks an unused record
+        ('txt', 'f8'),  # TXT stage readback
+        ('estimate', 'f8'),  # running error estimate (fs)
+        ('correction', 'f8'),  # last correction (ns)
+        ('atm_fb', 'f8'),  # last ATM FB value (ns)
+        ('atm_err', 'f8', (fields,)),
+    ])
+
+
+class frame_recorder():
+    """appends fixed-size records to memory-mapped .npy segment files
+
+    Each segment is a preallocated .npy file opened with np.memmap, so a
+    write is a slice assignment into the mapped region: no formatting and
+    no write() per record. Segments rotate when full; with keep_segments
+    set, the oldest segment files of this prefix are deleted. Recorders
+    sharing a directory need prefixes of their own, see record_prefix().
+    """
+    def __init__(self, directory, prefix='drift', segment_records=1 << 20, fields=16, keep_segments=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_records = int(segment_records)
+        self.fields = int(fields)
+        self.dtype = record_dtype(self.fields)
+        self.keep_segments = keep_segments
+        self.segment = None
+        self.segment_count = 0
+        self.written = 0  # records written over all segments
+        os.makedirs(directory, exist_ok=True)
+        self.open_segment()
+
+    def open_segment(self):
+        """closes the current segment and maps a new one"""
+        self.close()
+        self.segment_count += 1
+        name = f"{self.prefix}_{time.strftime('%Y%m%d_%H%M%S')}_{self.segment_count:04d}.npy"
+        self.path = os.path.join(self.directory, name)
+        self.segment = np.lib.format.open_memmap(self.path, mode='w+', dtype=self.dtype,
+                                                 shape=(self.segment_records,))
+        self.pos = 0
+        if self.keep_segments:
+            for old in segment_files(self.directory, self.prefix)[:-self.keep_segments]:
+                os.remove(old)
+
+    def reserve(self, n):
+        """mapped record slices for the next n records, rotating segments as needed"""
+        slices = []
+        while n > 0:
+            if self.pos == self.segment_records:
+                self.open_segment()
+            count = min(n, self.segment_records - self.pos)
+            slices.append(self.segment[self.pos:self.pos + count])
+            self.pos += count
+            self.written += count
+            n -= count
+        return slices
+
+    def record_frames(self, stamps, frames, masks, txt, estimate, correction, atm_fb):
+        """records a batch of raw frames (N, k) with their filter masks"""
+        k = min(frames.shape[1], self.fields)
+        start = 0
+        for records in self.reserve(len(stamps)):
+            end = start + len(records)
+            records['kind'] = RECORD_FRAME
+            records['flags'] = 0
+            records['filter_mask'] = masks[start:end]
+            records['n_fields'] = k
+            records['stamp'] = stamps[start:end]
+            records['txt'] = txt
+            records['estimate'] = estimate
+            records['correction'] = correction
+            records['atm_fb'] = atm_fb
+            records['atm_err'][:, :k] = frames[start:end, :k]
+            start = end
+
+    def record_correction(self, stamp, estimate, correction, atm_fb, applied):
+        """records one correction cycle"""
+        records = self.reserve(1)[0]
+        records['kind'] = RECORD_CORRECTION
+        records['flags'] = FLAG_APPLIED if applied else 0
+        records['filter_mask'] = 0
+        records['n_fields'] = 0
+        records['stamp'] = stamp
+        records['txt'] = np.nan
+        records['estimate'] = estimate
+        records['correction'] = correction
+        records['atm_fb'] = atm_fb
+
+    def close(self):
+        """flushes the current segment to disk"""
+        if self.segment is not None:
+            self.segment.flush()
+            self.segment = None
+
+
+def record_prefix(config_path):
+    """segment file prefix of the recorder of one hutch config, drift_<config name>"""
+    return 'drift_' + os.path.splitext(os.path.basename(config_path))[0]
+
+
+def segment_files(directory, prefix='drift'):
+    """recorded segment files of one prefix, oldest first"""
+    name = re.compile(re.escape(prefix) + r'_\d{8}_\d{6}_\d+\.npy$')  # not those of a longer prefix
+    return sorted(path for path in glob.glob(os.path.join(glob.escape(directory), '*.npy'))
+                  if name.match(os.path.basename(path)))
+
+
+def read_records(paths, prefix='drift'):
+    """loads the used records of one or more segment files, or a directory's files of one prefix, in write order"""
+    if isinstance(paths, str):
+        paths = segment_files(paths, prefix) if os.path.isdir(paths) else [paths]
+    chunks = []
+    for path in paths:
+        records = np.load(path, mmap_mode='r')
+        chunks.append(np.array(records[records['stamp'] != 0]))
+    if not chunks:
+        return np.zeros(0, dtype=record_dtype())
+    return np.concatenate(chunks)
@@ -0,0 +1,186 @@
+# drift_correction_replay.py
+# Replays recorded timetool streams through drift_correction.correct() with no CA and no sleeps.
+# usage: python drift_correction_replay.py RECORD_DIR [--sample-size 50] [--avg-mode 3] [--trace trace.csv]
+import argparse
+import json
+import os
+import time
+import numpy as np
+from drift_correction_main import drift_correction, sim_backend_for
+from drift_correction_filter import reason_bit, filter_frames, TXT_MOVING
+from drift_correction_recorder import read_records, record_prefix, RECORD_FRAME
+
+CONFIG_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# command line option -> drift_correction PV attribute
+OVERRIDES = {
+    'sample_size': 'sample_size_pv',
+    'avg_mode': 'avg_mode_pv',
+    'decay_factor': 'decay_factor_pv',
+    'fb_gain': 'fb_gain_pv',
+    'fb_direction': 'fb_direction_pv',
+    'pos_offset': 'pos_offset_pv',
+    'ampl_min': 'ampl_min_pv',
+    'ampl_max': 'ampl_max_pv',
+    'fwhm_min': 'fwhm_min_pv',
+    'fwhm_max': 'fwhm_max_pv',
+    'pos_fs_min': 'pos_fs_min_pv',
+    'pos_fs_max': 'pos_fs_max_pv',
+}
+
+
+class replay_finished(Exception):
+    """Raised when every recorded frame has been served."""
+    pass
+
+
+class replay_monitor():
+    """stands in for ttall_monitor, serving recorded frames on demand
+
+    Frames are served in chunks of at most chunk_size. Chunks never mix
+    frames recorded with and without the TXT moving bit. For moving chunks
+    the TXT readback is stepped at the first and last frame stamps, so the
+    loop's motion tracker (settle window 0) marks exactly the recorded
+    frames.
+
+    Recordings hold the primary timetool only, so the replay runs on it
+    alone, with the field layout of the config (ttall_fields). Each served
+    position is shifted by the difference between the replayed and the
+    recorded ATM FB. That assumes a linear response of
+    fb_direction * 1e6 fs per ns of feedback, so the replayed loop acts on
+    the errors its own corrections would have left.
+    """
+    def __init__(self, records, correction, chunk_size=10):
+        n_fields = int(records['n_fields'].max()) if len(records) else 0
+        self.stamps = records['stamp']
+        self.frames = records['atm_err'][:, :n_fields].copy()
+        self.recorded_fb = records['atm_fb']
+        self.moving = (records['filter_mask'] & reason_bit(TXT_MOVING)) != 0
+        self.correction = correction
+        self.backend = correction.backend
+        self.txt_pv = correction.txt_pv.name
+        self.fb_pv = correction.atm_fb_pv.name
+        self.pos_field = correction.primary.fields['pos_ps']
+        self.txt = 0.0
+        self.chunk_size = chunk_size
+        self.pos = 0  # frames served
+        self.received = 0
+        self.dropped = 0
+
+    def drain(self, timeout=60.0):
+        if self.pos >= len(self.stamps):
+            raise replay_finished
+        end = min(self.pos + self.chunk_size, len(self.stamps))
+        moving = self.moving[self.pos]
+        change = np.flatnonzero(self.moving[self.pos:end] != moving)
+        if len(change):
+            end = self.pos + change[0]
+        if moving:
+            for stamp in (self.stamps[self.pos], self.stamps[end - 1]):
+                self.txt += 1.0
+                self.backend.write(self.txt_pv, self.txt, stamp)
+        fb_shift = self.backend.read(self.fb_pv)[0] - self.recorded_fb[self.pos:end]
+        self.frames[self.pos:end, self.pos_field] -= (self.correction.params.get('fb_direction') * fb_shift * 1000)
+        stamps, frames = self.stamps[self.pos:end], self.frames[self.pos:end].copy()
+        self.received += len(stamps)
+        self.pos = end
+        return stamps, frames
+
+    def clock(self):
+        """stamp of the newest served frame, the replay's current time"""
+        return self.stamps[self.pos - 1] if self.pos else 0.0
+
+    def stop(self):
+        pass
+
+
+def replay(records, overrides=None, config_dir=CONFIG_DIR, hutch_selector=0, chunk_size=10):
+    """runs the correction loop over recorded frames, returns (trace, summary)"""
+    frames = records[records['kind'] == RECORD_FRAME]
+    backend = sim_backend_for(config_dir, hutch_selector, ttall_rate=None)
+    correction = drift_correction(backend, config_dir)
+    if correction.ttall_monitor is not None:
+        correction.ttall_monitor.stop()
+        for source in correction.extra_sources:
+            source.monitor.stop()
+    correction.extra_sources = []  # not recorded
+    correction.sources = [correction.primary]
+    for name, value in (overrides or {}).items():
+        backend.write(getattr(correction, OVERRIDES[name]).name, value)
+    start_fb = float(frames['atm_fb'][0]) if len(frames) else 0.0
+    backend.write(correction.atm_fb_pv.name, start_fb)
+    correction.cycle_deadline = None  # no wall-clock pacing offline
+    correction.txt_tracker.settle = 0.0  # recorded moving bits already include the settle window
+    monitor = replay_monitor(frames, correction, chunk_size)
+    correction.ttall_monitor = monitor
+    correction.clock = monitor.clock  # stale cutoff and fusion on recorded time
+    trace = []  # frames served, last frame stamp, avg_error (fs), correction (ns), atm_fb (ns)
+    t0 = time.perf_counter()
+    while True:
+        count = correction.correction_count
+        try:
+            correction.correct()
+        except replay_finished:
+            break
+        if correction.correction_count != count:
+            trace.append((monitor.pos, monitor.stamps[monitor.pos - 1], correction.avg_error,
+                          correction.correction, correction.atm_fb))
+    wall = time.perf_counter() - t0
+    correction.close()
+    backend.stop()
+    trace = np.array(trace, dtype=float).reshape(-1, 5)
+    return trace, summarize(frames, monitor, trace, correction, wall)
+
+
+def summarize(frames, monitor, trace, correction, wall):
+    """error statistics of the recorded and the replayed (residual) streams over accepted frames"""
+    n_fields = int(frames['n_fields'].max()) if len(frames) else 0
+    atm_err = frames['atm_err'][:, :n_fields]
+    pos_ps, ampl, fwhm = correction.primary.columns(atm_err)
+    pos_fs = pos_ps * 1000 - correction.flt_pos_offset
+    residual = monitor.frames[:, monitor.pos_field] * 1000 - correction.flt_pos_offset
+    accepted = filter_frames(ampl, fwhm, residual, correction.limits, monitor.moving) == 0
+    residual = residual[accepted]
+    span = float(frames['stamp'][-1] - frames['stamp'][0]) if len(frames) > 1 else 0.0
+
+    def stats(values):
+        if len(values) == 0:
+            return None
+        return {'mean': float(np.mean(values)), 'std': float(np.std(values)),
+                'rms': float(np.sqrt(np.mean(values ** 2))), 'p95_abs': float(np.percentile(np.abs(values), 95))}
+    return {
+        'frames': len(frames),
+        'accepted': int(accepted.sum()),
+        'acceptance_rate': float(accepted.mean()) if len(frames) else None,
+        'corrections': len(trace),
+        'recorded_error_fs': stats(pos_fs[accepted]),
+        'residual_fs': stats(residual),
+        'correction_fs': stats(trace[:, 3] * 1000000),
+        'recorded_span_s': span,
+        'wall_s': wall,
+        'speedup': span / wall if wall else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded timetool frames through the correction loop')
+    parser.add_argument('records', help='recorder directory or segment file')
+    parser.add_argument('--hutch', type=int, default=0, help='hutch selector (0=cRIXS, 1=qRIXS) for the config')
+    parser.add_argument('--chunk-size', type=int, default=10,
+                        help='frames served per drain (1 reproduces per-frame loop dynamics exactly)')
+    parser.add_argument('--trace', help='CSV file for the correction trace')
+    for name in OVERRIDES:
+        parser.add_argument('--' + name.replace('_', '-'), type=float, help=f'{name} for the replay')
+    args = parser.parse_args()
+
+    overrides = {name: getattr(args, name) for name in OVERRIDES if getattr(args, name) is not None}
+    config_file = 'qrixs_atm_fb.json' if (args.hutch == 1) else 'crixs_atm_fb.json'
+    records = read_records(args.records, record_prefix(config_file))  # this hutch's segments in a shared directory
+    trace, summary = replay(records, overrides, hutch_selector=args.hutch, chunk_size=args.chunk_size)
+    if args.trace:
+        np.savetxt(args.trace, trace, delimiter=',', header='frames_served,stamp,avg_error_fs,correction_ns,atm_fb_ns')
+    print(json.dumps(summary, indent=4))
+
+
+if __name__ == "__main__":
+    main()
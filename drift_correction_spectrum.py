@@ -0,0 +1,171 @@
+# drift_correction_spectrum.py
+# Background spectral analysis of the error stream and the applied corrections, for loop tuning.
+import threading
+import numpy as np
+
+
+class sample_ring():
+    """fixed-capacity ring of (stamp, value, ...) rows, overwriting the oldest"""
+    def __init__(self, capacity, fields):
+        self.data = np.zeros((max(int(capacity), 1), fields))
+        self.pos = 0  # rows written in total
+
+    def __len__(self):
+        return min(self.pos, len(self.data))
+
+    def extend(self, rows):
+        """appends the rows of an (n, fields) array"""
+        rows = rows[-len(self.data):]
+        start = self.pos % len(self.data)
+        end = start + len(rows)
+        if end <= len(self.data):
+            self.data[start:end] = rows
+        else:
+            split = len(self.data) - start
+            self.data[start:] = rows[:split]
+            self.data[:end - len(self.data)] = rows[split:]
+        self.pos += len(rows)
+
+    def values(self):
+        """copy of the stored rows, oldest first"""
+        if self.pos <= len(self.data):
+            return self.data[:self.pos].copy()
+        start = self.pos % len(self.data)
+        return np.concatenate((self.data[start:], self.data[:start]))
+
+    def clear(self):
+        self.pos = 0
+
+
+def grid_mean(stamps, values, edges):
+    """mean of values per bin of edges, empty bins linearly interpolated"""
+    n_bins = len(edges) - 1
+    index = np.searchsorted(edges, stamps, side='right') - 1
+    inside = (index >= 0) & (index < n_bins)
+    counts = np.bincount(index[inside], minlength=n_bins)
+    sums = np.bincount(index[inside], weights=values[inside], minlength=n_bins)
+    filled = counts > 0
+    bins = np.arange(n_bins)
+    return np.interp(bins, bins[filled], sums[filled] / counts[filled])
+
+
+def grid_sum(stamps, values, edges):
+    """sum of values per bin of edges"""
+    n_bins = len(edges) - 1
+    index = np.searchsorted(edges, stamps, side='right') - 1
+    inside = (index >= 0) & (index < n_bins)
+    return np.bincount(index[inside], weights=values[inside], minlength=n_bins)
+
+
+def welch(x, y, segment, rate):
+    """Welch estimates with a Hann window and 50 % overlap: frequencies, Pxx, Pyy, Pxy
+
+    Densities are one-sided, in units^2/Hz. Each segment has its mean
+    removed.
+    """
+    step = segment // 2
+    starts = range(0, len(x) - segment + 1, step)
+    window = np.hanning(segment)
+    scale = 1.0 / (rate * np.sum(window ** 2))
+    xs = np.array([x[i:i + segment] for i in starts])
+    ys = np.array([y[i:i + segment] for i in starts])
+    fx = np.fft.rfft((xs - xs.mean(axis=1, keepdims=True)) * window, axis=1)
+    fy = np.fft.rfft((ys - ys.mean(axis=1, keepdims=True)) * window, axis=1)
+    pxx = np.mean(np.abs(fx) ** 2, axis=0) * scale
+    pyy = np.mean(np.abs(fy) ** 2, axis=0) * scale
+    pxy = np.mean(np.conj(fx) * fy, axis=0) * scale
+    pxx[1:-1] *= 2  # one-sided, DC and Nyquist appear once
+    pyy[1:-1] *= 2
+    pxy[1:-1] *= 2
+    return np.fft.rfftfreq(segment, 1.0 / rate), pxx, pyy, pxy
+
+
+class spectrum_worker():
+    """keeps the recent error and correction streams and analyses them on its own thread
+
+    The control loop only appends rows (add_errors, add_correction). Every
+    interval seconds the worker copies the rings, puts them on a uniform
+    grid of `rate` Hz (error: mean per bin, gaps interpolated; correction:
+    sum per bin) and computes Welch estimates over segments of `segment`
+    bins:
+    - error and correction power spectral densities (fs^2/Hz)
+    - |H| of the error to correction transfer, |Pxy| / Pxx
+    - closed / open loop error PSD ratio, below 1 where the loop
+      suppresses noise and above 1 where it amplifies it
+    The open-loop error is the measured error with the expected response
+    of the applied corrections added back. `publish(results)` runs on the
+    worker thread with a dict of arrays keyed freq, error_psd,
+    correction_psd, transfer, suppression.
+    """
+    def __init__(self, publish, capacity=65536, rate=10.0, segment=256, interval=30.0, attach=None):
+        self.publish = publish
+        self.rate = float(rate)
+        self.segment = int(segment)
+        self.interval = float(interval)
+        self.attach = attach  # called once on the worker thread, e.g. to attach the CA context
+        self.errors = sample_ring(capacity, 3)  # stamp, closed-loop error, open-loop error (fs)
+        self.corrections = sample_ring(capacity, 2)  # stamp, expected response (fs)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.runs = 0  # analyses published
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, name='spectrum', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5.0)
+
+    def clear(self):
+        with self.lock:
+            self.errors.clear()
+            self.corrections.clear()
+
+    def add_errors(self, stamps, errors, loop_offset):
+        """appends accepted errors (fs) with the loop's summed correction response at that time"""
+        rows = np.column_stack((stamps, errors, errors + loop_offset))
+        with self.lock:
+            self.errors.extend(rows)
+
+    def add_correction(self, stamp, response):
+        """appends the expected response (fs) of an applied correction"""
+        with self.lock:
+            self.corrections.extend(np.array([[stamp, response]]))
+
+    def loop(self):
+        if self.attach is not None:
+            self.attach()
+        while not self.stop_event.wait(self.interval):
+            try:
+                results = self.analyse()
+                if results is not None:
+                    self.publish(results)
+                    self.runs += 1
+            except Exception as e:
+                print(f"[ERROR] Spectrum analysis failed: {e}")
+
+    def analyse(self):
+        """Welch estimates over the buffered streams, None with less than two segments of data"""
+        with self.lock:
+            errors = self.errors.values()
+            corrections = self.corrections.values()
+        if len(errors) < 2:
+            return None
+        end = errors[-1, 0]
+        n_bins = int((end - errors[0, 0]) * self.rate)
+        if n_bins < 2 * self.segment:
+            return None
+        edges = end - np.arange(n_bins, -1, -1) / self.rate
+        closed = grid_mean(errors[:, 0], errors[:, 1], edges)
+        opened = grid_mean(errors[:, 0], errors[:, 2], edges)
+        response = grid_sum(corrections[:, 0], corrections[:, 1], edges)
+        freq, p_err, p_corr, p_cross = welch(closed, response, self.segment, self.rate)
+        p_open = welch(opened, opened, self.segment, self.rate)[1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            transfer = np.abs(p_cross) / p_err
+            suppression = p_err / p_open
+        return {'freq': freq, 'error_psd': p_err, 'correction_psd': p_corr,
+                'transfer': transfer, 'suppression': suppression}
@@ -0,0 +1,126 @@
+# test_drift_correction_filter.py
+# Frame filter masks against a per-frame reference filter, the rejection window and the limit tuner.
+import numpy as np
+import pytest
+from drift_correction_filter import (AMPL_LOW, AMPL_HIGH, FWHM_LOW, FWHM_HIGH, POS_LOW, POS_HIGH, TXT_MOVING,
+                                     FILTER_CODES, WINDOW_COLUMNS, filter_frames, filter_state, reason_bit,
+                                     rejection_window, limit_tuner)
+
+LIMITS = {'ampl_min': 0.01, 'ampl_max': 0.2, 'fwhm_min': 30.0, 'fwhm_max': 250.0,
+          'pos_fs_min': -500.0, 'pos_fs_max': 500.0}
+
+
+def reference_codes(ampl, fwhm, pos_fs, moving):
+    """failed conditions of one frame, comparisons written out one by one"""
+    codes = set()
+    if not (ampl > LIMITS['ampl_min']):
+        codes.add(AMPL_LOW)
+    if not (ampl < LIMITS['ampl_max']):
+        codes.add(AMPL_HIGH)
+    if not (fwhm > LIMITS['fwhm_min']):
+        codes.add(FWHM_LOW)
+    if not (fwhm < LIMITS['fwhm_max']):
+        codes.add(FWHM_HIGH)
+    if not (pos_fs > LIMITS['pos_fs_min']):
+        codes.add(POS_LOW)
+    if not (pos_fs < LIMITS['pos_fs_max']):
+        codes.add(POS_HIGH)
+    if moving:
+        codes.add(TXT_MOVING)
+    return codes
+
+
+def test_filter_frames_matches_reference():
+    rng = np.random.default_rng(3)
+    n = 5000
+    ampl = rng.uniform(-0.05, 0.3, n)
+    fwhm = rng.uniform(0.0, 300.0, n)
+    pos_fs = rng.uniform(-700.0, 700.0, n)
+    for values in (ampl, fwhm, pos_fs):
+        values[rng.random(n) < 0.02] = np.nan
+    ampl[:3] = LIMITS['ampl_min'], LIMITS['ampl_max'], np.nan  # limits themselves fail
+    fwhm[:3], pos_fs[:3] = 100.0, 0.0
+    moving = rng.random(n) < 0.1
+    moving[:3] = False
+    masks = filter_frames(ampl, fwhm, pos_fs, LIMITS, moving)
+    assert masks.dtype == np.uint16
+    for i in range(n):
+        codes = reference_codes(ampl[i], fwhm[i], pos_fs[i], moving[i])
+        assert masks[i] == sum(reason_bit(code) for code in codes)
+        assert filter_state(masks[i]) == max(codes, default=0)
+    assert masks[0] == reason_bit(AMPL_LOW) and masks[1] == reason_bit(AMPL_HIGH)
+    assert masks[2] & reason_bit(AMPL_LOW) and masks[2] & reason_bit(AMPL_HIGH)
+
+
+def test_filter_frames_scalar_txt_moving():
+    ampl, fwhm, pos_fs = np.array([0.1, 0.1]), np.array([100.0, 100.0]), np.array([0.0, 900.0])
+    assert list(filter_frames(ampl, fwhm, pos_fs, LIMITS)) == [0, reason_bit(POS_HIGH)]
+    masks = filter_frames(ampl, fwhm, pos_fs, LIMITS, txt_moving=True)
+    assert list(masks) == [reason_bit(TXT_MOVING), reason_bit(TXT_MOVING) | reason_bit(POS_HIGH)]
+    assert [filter_state(mask) for mask in masks] == [TXT_MOVING, TXT_MOVING]
+
+
+def test_rejection_window_matches_recount():
+    rng = np.random.default_rng(12)
+    window = rejection_window(window=10.0, buckets=10)
+    history = []  # (time, mask) of every frame added
+    now = 1000.0
+    for step in range(400):
+        now += float(rng.exponential(0.3)) if rng.random() < 0.95 else 15.0  # now and then a gap over the window
+        masks = rng.integers(0, 1 << 8, int(rng.integers(0, 20))).astype(np.uint16)
+        masks[rng.random(len(masks)) < 0.5] = 0
+        window.add(masks, now)
+        history.extend((now, mask) for mask in masks)
+        # the window holds the frames of its 10 buckets, the newest one partly elapsed
+        first = (now // 1.0 - 9) * 1.0
+        kept = np.array([mask for stamp, mask in history if stamp >= first], dtype=np.uint16)
+        expected = [len(kept), int(np.count_nonzero(kept == 0))]
+        expected += [int(np.count_nonzero(kept & reason_bit(code))) for code in FILTER_CODES]
+        waveform = window.waveform(now)
+        assert waveform[1:] == expected
+        if expected[0]:
+            assert waveform[0] == expected[1] / expected[0] == window.acceptance()
+        else:
+            assert np.isnan(waveform[0])
+
+
+def test_rejection_window_expires_everything_after_a_gap():
+    window = rejection_window(window=10.0, buckets=10)
+    window.add(np.array([0, reason_bit(POS_HIGH) | reason_bit(TXT_MOVING)], dtype=np.uint16), 5.0)
+    assert window.waveform(5.0) == [0.5, 2, 1, 0, 0, 0, 0, 0, 1, 1]
+    assert window.waveform(14.9) == [0.5, 2, 1, 0, 0, 0, 0, 0, 1, 1]
+    assert window.waveform(15.0)[1:] == [0] * len(WINDOW_COLUMNS)
+
+
+def frames_with_junk(rng, n, junk=0.2):
+    """good frames around ampl 0.05, FWHM 100 and position 0, and a share of junk frames"""
+    ampl, fwhm, pos_fs = rng.normal(0.05, 0.005, n), rng.normal(100.0, 10.0, n), rng.normal(0.0, 30.0, n)
+    bad = rng.random(n) < junk
+    ampl[bad] = 0.001
+    fwhm[bad] = rng.uniform(0.0, 1000.0, bad.sum())
+    pos_fs[bad] = rng.uniform(-5000.0, 5000.0, bad.sum())
+    return ampl, fwhm, pos_fs
+
+
+def test_limit_tuner_converges_on_good_frames():
+    rng = np.random.default_rng(22)
+    tuner = limit_tuner(window=60.0, buckets=6, width=5.0, step=0.25, min_count=200)
+    limits = {'ampl_min': 0.0, 'ampl_max': 1.0, 'fwhm_min': 0.0, 'fwhm_max': 500.0,
+              'pos_fs_min': -2000.0, 'pos_fs_max': 2000.0}
+    assert tuner.limits(limits, now=0.0) == {}  # nothing learned yet
+    for step in range(40):
+        now = step * 1.0
+        ampl, fwhm, pos_fs = frames_with_junk(rng, 200)
+        tuner.add(ampl, fwhm, pos_fs, filter_frames(ampl, fwhm, pos_fs, limits), now=now)
+        proposed = tuner.limits(limits, now=now)
+        for low, high in (('ampl_min', 'ampl_max'), ('fwhm_min', 'fwhm_max'), ('pos_fs_min', 'pos_fs_max')):
+            step_max = 0.25 * (limits[high] - limits[low]) + 1e-9  # each proposal moves by a quarter span at most
+            assert abs(proposed.get(low, limits[low]) - limits[low]) <= step_max
+            assert abs(proposed.get(high, limits[high]) - limits[high]) <= step_max
+        limits.update(proposed)
+    # median plus or minus five robust sigmas of the good frames, the junk leaves no trace
+    assert limits['fwhm_min'] == pytest.approx(50.0, abs=5.0) and limits['fwhm_max'] == pytest.approx(150.0, abs=5.0)
+    assert limits['pos_fs_min'] == pytest.approx(-150.0, abs=10.0)
+    assert limits['pos_fs_max'] == pytest.approx(150.0, abs=10.0)
+    assert 0.01 < limits['ampl_min'] < 0.04 and limits['ampl_max'] == pytest.approx(0.075, abs=0.005)
+    assert tuner.limits(limits, now=200.0) == {}  # the window has expired
@@ -0,0 +1,72 @@
+# test_drift_correction_fusion.py
+# Randomised checks of fuse() against a per-shot weighted mean, and of holding back incomplete shots.
+import numpy as np
+from drift_correction_fusion import fuse
+
+
+def random_batches(rng, n_sources, n_shots, tolerance):
+    """per source (stamps, ampl, fwhm, pos_fs, variance) seeing a random subset of shots, and the shot of each sample"""
+    shot_times = np.cumsum(rng.uniform(3 * tolerance, 10 * tolerance, n_shots))
+    batches, shots = [], []
+    for source in range(n_sources):
+        seen = np.flatnonzero(rng.random(n_shots) < 0.7)
+        stamps = shot_times[seen] + rng.uniform(0.0, tolerance / 2, len(seen))  # within tolerance of the shot
+        variance = None if source == n_sources - 1 else float(rng.uniform(100.0, 3000.0))
+        batches.append((stamps, *rng.normal(0.0, 1.0, (3, len(seen))), variance))
+        shots.append(seen)
+    return batches, shots
+
+
+def test_fuse_matches_weighted_mean_per_shot():
+    rng = np.random.default_rng(21)
+    tolerance = 0.004
+    for trial in range(50):
+        batches, shots = random_batches(rng, int(rng.integers(1, 4)), 200, tolerance)
+        stamps, ampl, fwhm, pos_fs, counts, held = fuse(batches, tolerance)
+        known = [batch[4] for batch in batches if batch[4] is not None]
+        default = np.mean(known) if known else 1.0
+        all_shots = np.concatenate(shots)
+        ids = np.unique(all_shots)
+        assert len(stamps) == len(ids)
+        assert all(len(column) == 0 for columns in held for column in columns)  # nothing held without now
+        for i, shot in enumerate(ids):
+            rows = [(batch, np.flatnonzero(seen == shot)) for batch, seen in zip(batches, shots)]
+            rows = [(batch, index[0]) for batch, index in rows if len(index)]
+            weights = np.array([1.0 / (batch[4] if batch[4] else default) for batch, j in rows])
+            assert counts[i] == len(rows)
+            assert stamps[i] == max(batch[0][j] for batch, j in rows)
+            for fused, column in ((ampl, 1), (fwhm, 2), (pos_fs, 3)):
+                expected = np.sum(weights * np.array([batch[column][j] for batch, j in rows])) / np.sum(weights)
+                assert np.isclose(fused[i], expected)
+
+
+def test_fuse_holds_back_incomplete_shots():
+    tolerance = 0.004
+    first = (np.array([1.000, 1.010]), np.ones(2), np.ones(2), np.array([10.0, 20.0]), 100.0)
+    second = (np.array([1.001]), np.ones(1), np.ones(1), np.array([30.0]), 100.0)
+    # the shot at 1.010 still misses the second source and is recent: held back
+    stamps, ampl, fwhm, pos_fs, counts, held = fuse([first, second], tolerance, now=1.011)
+    assert np.allclose(pos_fs, [20.0]) and counts.tolist() == [2]
+    assert held[0][0].tolist() == [1.010] and len(held[1][0]) == 0
+    # its partner arrives with the next batch, in front of which the held sample goes
+    late = (np.array([1.012]), np.ones(1), np.ones(1), np.array([40.0]), 100.0)
+    batches = [(*held[0], 100.0), (*(np.concatenate(pair) for pair in zip(held[1], late[:4])), 100.0)]
+    stamps, ampl, fwhm, pos_fs, counts, held = fuse(batches, tolerance, now=1.013)
+    assert np.allclose(pos_fs, [30.0]) and counts.tolist() == [2]
+    # with no partner the shot goes out alone once the tolerance has passed
+    stamps, ampl, fwhm, pos_fs, counts, held = fuse([first, second], tolerance, now=1.015)
+    assert np.allclose(pos_fs, [20.0, 20.0]) and counts.tolist() == [2, 1]
+    assert all(len(columns[0]) == 0 for columns in held)
+
+
+def test_fuse_repeated_source_starts_a_new_shot():
+    # one source polled faster than the tolerance, the other dead: one shot per sample,
+    # each released once its tolerance has passed instead of chaining into a held shot
+    tolerance = 0.004
+    stamps = 1.0 + 0.001 * np.arange(20)
+    live = (stamps, np.ones(20), np.ones(20), np.arange(20.0), 100.0)
+    dead = (np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0), None)
+    fused_stamps, ampl, fwhm, pos_fs, counts, held = fuse([dead, live], tolerance, now=stamps[-1] + 0.0005)
+    assert counts.tolist() == [1] * 16
+    assert np.allclose(pos_fs, np.arange(16.0))
+    assert np.allclose(held[1][3], np.arange(16.0, 20.0))
@@ -0,0 +1,63 @@
+# test_drift_correction_main.py
+# The correction loop on a simulated backend, fed frame by frame.
+import os
+import numpy as np
+import pytest
+from drift_correction_main import drift_correction, sim_backend_for, cycle_deadline_reached
+
+CONFIG_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def loop():
+    backend = sim_backend_for(CONFIG_DIR, ttall_rate=None)  # sample_size 50, fb_gain 0.5, avg_mode 1
+    correction = drift_correction(backend, CONFIG_DIR)
+    yield backend, correction
+    correction.close()
+    backend.stop()
+
+
+def feed(backend, correction, n, error_fs):
+    """publishes n TTALL frames with a fixed timing error"""
+    fields = correction.primary.fields
+    for i in range(n):
+        frame = np.zeros(8)
+        frame[fields['pos_ps']], frame[fields['ampl']], frame[fields['fwhm']] = error_fs / 1000, 0.05, 100.0
+        backend.write(correction.atm_err_pv.name, frame)
+
+
+def test_deadline_partial_fill_weights_the_correction(loop):
+    backend, correction = loop
+    correction.cycle_deadline = 0.3
+    feed(backend, correction, 20, 200.0)
+    correction.correct()
+    assert correction.partial_count == 1 and correction.fill_weight == 20 / 50
+    assert correction.correction == pytest.approx(200.0 / 1000000 * 0.5 * 20 / 50)
+    assert backend.read(correction.atm_fb_pv.name)[0] == pytest.approx(correction.correction)
+
+    feed(backend, correction, correction.min_samples - 1, 200.0)  # too few for a correction
+    with pytest.raises(cycle_deadline_reached):
+        correction.correct()
+    assert correction.deadline_count == 1 and correction.correction_count == 1
+    correction.end_deadline_cycle()
+
+    feed(backend, correction, 50, 100.0)  # the kept samples plus new ones fill the buffer, full weight
+    correction.correct()
+    assert correction.partial_count == 1 and correction.fill_weight == 1.0
+    kept = correction.min_samples - 1
+    assert correction.correction == pytest.approx((kept * 200.0 + (50 - kept) * 100.0) / 50 / 1000000 * 0.5)
+
+
+def test_deadline_seconds(loop):
+    backend, correction = loop
+    correction.cycle_deadline = None
+    assert correction.deadline_seconds() is None
+    correction.cycle_deadline = 0.3
+    assert correction.deadline_seconds() == 0.3
+    correction.cycle_deadline, correction.sample_size = 'auto', 50
+    correction.accept_rate = None  # nothing measured yet
+    assert correction.deadline_seconds() == 60.0
+    correction.accept_rate = 100.0
+    assert correction.deadline_seconds() == pytest.approx(3.0 * 50 / 100.0)
+    correction.accept_rate = 1.0
+    assert correction.deadline_seconds() == 60.0
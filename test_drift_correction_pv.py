@@ -0,0 +1,101 @@
+# test_drift_correction_pv.py
+# Frame queue checks against a plain deque, short frames, the channel registry and motion tracking.
+from collections import deque
+import numpy as np
+from drift_correction_pv import frame_queue, motion_tracker, sim_backend
+
+
+def test_frame_queue_wrap_around_matches_deque():
+    rng = np.random.default_rng(11)
+    for capacity in (1, 2, 7, 64):
+        queue = frame_queue(capacity)
+        expected = deque()
+        dropped = overflows = high_water = 0
+        full = False
+        stamp = 0.0
+        for step in range(3000):
+            for _ in range(int(rng.integers(0, 2 * capacity + 2))):  # producer burst
+                stamp += 1.0
+                frame = rng.normal(size=6)
+                pushed = queue.push(stamp, frame)
+                assert pushed == (len(expected) < capacity)
+                if pushed:
+                    expected.append((stamp, frame))
+                    high_water = max(high_water, len(expected))
+                    full = False
+                else:
+                    dropped += 1
+                    overflows += not full
+                    full = True
+            assert len(queue) == len(expected)
+            if expected and (rng.random() < 0.7):  # consumer drains everything queued
+                stamps, frames = queue.pop_all(timeout=0.0)
+                assert stamps.tolist() == [s for s, f in expected]
+                assert np.array_equal(frames, np.array([f for s, f in expected]))
+                expected.clear()
+                assert len(queue) == 0
+        assert (queue.dropped, queue.overflows, queue.high_water) == (dropped, overflows, high_water)
+
+
+def test_frame_queue_short_frame_is_nan_filled():
+    queue = frame_queue(2)
+    for stamp in range(3):  # through every slot, so the next push reuses a written one
+        queue.push(float(stamp), np.arange(6.0) + 10 * stamp)
+        queue.pop_all(timeout=0.0)
+    queue.push(3.0, np.array([1.0, 2.0]))
+    stamps, frames = queue.pop_all(timeout=0.0)
+    assert frames[0, :2].tolist() == [1.0, 2.0]
+    assert np.isnan(frames[0, 2:]).all()
+
+
+def test_registry_shares_channels_by_name():
+    backend = sim_backend({'A': 1.0, 'B': 2.0})
+    first, second = backend.pv('A'), backend.pv('A')
+    assert first.channel is second.channel
+    assert len(backend.channels['A']) == 1
+    seconds, names = backend.connect_all()
+    assert sorted(names) == ['A']
+    backend.pv('B')
+    seconds, names = backend.connect_all()  # only the new channel
+    assert names == ['B']
+    state = backend.registry.state()
+    assert state['A']['connected'] and state['B']['connected']
+    assert state['A']['connect_ms'] is not None and state['A']['error'] is None
+
+
+def test_registry_records_failed_connects():
+    backend = sim_backend({'A': 1.0})
+    backend.disconnect('A', 60.0)
+    backend.pv('A')
+    seconds, names = backend.connect_all(timeout=0.01)
+    state = backend.registry.state()['A']
+    assert not state['connected'] and state['error']
+    assert any(line.startswith('[ERROR] A') for line in backend.registry.report(seconds, names))
+
+
+def test_motion_tracker_marks_readback_moves_with_settle():
+    backend = sim_backend({'TXT': 0.0})
+    tracker = motion_tracker(backend.pv('TXT'), settle=0.5, resolution=0.1)
+    tracker.start()
+    backend.write('TXT', 0.05, 100.0)  # below the resolution
+    backend.write('TXT', 1.0, 101.0)
+    backend.write('TXT', 2.0, 101.2)  # merges with the settling interval
+    backend.write('TXT', 3.0, 110.0)
+    stamps = np.array([100.0, 100.9, 101.0, 101.5, 101.7, 101.8, 109.0, 110.3, 111.0])
+    expected = [False, False, True, True, True, False, False, True, False]
+    assert list(tracker.moving_mask(stamps)) == expected
+    assert np.allclose(list(tracker.intervals), [(101.0, 101.2), (110.0, 110.0)])
+    tracker.stop()
+    backend.write('TXT', 4.0, 120.0)  # no longer monitored
+    assert not tracker.moving_mask([120.0])[0]
+
+
+def test_motion_tracker_status_opens_and_closes_intervals():
+    backend = sim_backend({'TXT': 0.0, 'TXT:DMOV': 1})
+    tracker = motion_tracker(backend.pv('TXT'), dmov_pv=backend.pv('TXT:DMOV'), settle=0.5)
+    tracker.start()
+    backend.write('TXT:DMOV', 0, 200.0)
+    assert list(tracker.moving_mask([199.0, 200.0, 500.0])) == [False, True, True]  # open until DMOV returns
+    backend.write('TXT:DMOV', 1, 203.0)
+    assert list(tracker.moving_mask([199.0, 202.0, 203.4, 203.6])) == [False, True, True, False]
+    assert len(tracker.moving_mask([])) == 0
@@ -0,0 +1,49 @@
+# test_drift_correction_recorder.py
+# Recorder round trips through the segment files, rotation and per-prefix pruning.
+import os
+import numpy as np
+from drift_correction_recorder import (frame_recorder, read_records, record_prefix, segment_files,
+                                       RECORD_FRAME, RECORD_CORRECTION, FLAG_APPLIED)
+
+
+def test_recorder_round_trip_across_segments(tmp_path):
+    rng = np.random.default_rng(9)
+    recorder = frame_recorder(str(tmp_path), prefix='drift_test', segment_records=7, fields=4)
+    stamps = 1.7e9 + np.arange(20) * 0.01
+    frames = rng.normal(size=(20, 6))  # wider than the record, the first 4 fields are kept
+    masks = rng.integers(0, 1 << 8, 20).astype(np.uint16)
+    recorder.record_frames(stamps[:12], frames[:12], masks[:12], 1.5, 10.0, 0.001, 2.0)
+    recorder.record_correction(stamps[11], 10.0, 0.002, 2.002, True)
+    recorder.record_frames(stamps[12:], frames[12:], masks[12:], 2.5, 11.0, 0.002, 2.002)
+    recorder.close()
+    assert recorder.written == 21
+    assert len(segment_files(str(tmp_path), 'drift_test')) == 3
+
+    records = read_records(str(tmp_path), 'drift_test')  # the unused tail of the last segment is skipped
+    assert len(records) == 21
+    kept = records[records['kind'] == RECORD_FRAME]
+    assert np.array_equal(kept['stamp'], stamps)
+    assert np.array_equal(kept['atm_err'], frames[:, :4])
+    assert np.array_equal(kept['filter_mask'], masks)
+    assert list(kept['txt'][[0, -1]]) == [1.5, 2.5] and np.all(kept['n_fields'] == 4)
+    cycle = records[12]
+    assert cycle['kind'] == RECORD_CORRECTION and cycle['flags'] == FLAG_APPLIED
+    assert (cycle['correction'], cycle['atm_fb']) == (0.002, 2.002)
+
+
+def test_keep_segments_prunes_only_its_own_prefix(tmp_path):
+    directory = str(tmp_path)
+    crixs = frame_recorder(directory, prefix=record_prefix('/x/crixs_atm_fb.json'), segment_records=1)
+    qrixs = frame_recorder(directory, prefix=record_prefix('qrixs_atm_fb.json'), segment_records=1,
+                           keep_segments=2)
+    assert crixs.prefix == 'drift_crixs_atm_fb' and crixs.path != qrixs.path
+    for i in range(5):
+        for recorder in (crixs, qrixs):
+            recorder.record_correction(1.0 + i, 0.0, 0.0, 0.0, False)
+    crixs.close()
+    qrixs.close()
+    assert len(segment_files(directory, crixs.prefix)) == 5  # no limit, none deleted
+    assert len(segment_files(directory, qrixs.prefix)) == 2
+    assert os.path.exists(qrixs.path)
+    assert len(read_records(directory, crixs.prefix)) == 5
+    assert segment_files(directory) == []  # the default prefix matches neither
@@ -0,0 +1,39 @@
+# test_drift_correction_replay.py
+# A recorded open-loop stream replayed through the correction loop, from the segment files.
+import numpy as np
+from drift_correction_filter import reason_bit, TXT_MOVING
+from drift_correction_recorder import frame_recorder, read_records, record_prefix
+from drift_correction_replay import replay
+
+
+def record_open_loop(directory, n=2000, error_fs=300.0, jitter_fs=30.0, seed=10):
+    """frames with a constant timing error and ATM FB left at 0, in the crixs layout"""
+    rng = np.random.default_rng(seed)
+    stamps = 1.7e9 + np.arange(n) / 120.0
+    frames = np.zeros((n, 8))
+    frames[:, 1] = (error_fs + rng.normal(0.0, jitter_fs, n)) / 1000  # pos_ps
+    frames[:, 2] = 0.05  # ampl
+    frames[:, 5] = 100.0  # fwhm
+    masks = np.zeros(n, dtype=np.uint16)
+    masks[500:600] = reason_bit(TXT_MOVING)
+    recorder = frame_recorder(directory, prefix=record_prefix('crixs_atm_fb.json'), segment_records=700)
+    for start in range(0, n, 100):
+        end = start + 100
+        recorder.record_frames(stamps[start:end], frames[start:end], masks[start:end], 0.0, 0.0, 0.0, 0.0)
+    recorder.close()
+
+
+def test_replay_closes_the_loop_on_a_recording(tmp_path):
+    record_open_loop(str(tmp_path))
+    records = read_records(str(tmp_path), record_prefix('crixs_atm_fb.json'))
+    trace, summary = replay(records)
+    assert summary['frames'] == 2000
+    assert summary['accepted'] == 1900  # the moving frames are rejected
+    assert abs(summary['recorded_error_fs']['mean'] - 300.0) < 5.0
+    assert summary['corrections'] == len(trace) > 20
+    assert abs(summary['residual_fs']['mean']) < 30.0  # the replayed loop removes the error
+    assert abs(trace[-1, 4] * 1000000 - 300.0) < 30.0  # ATM FB ends near the error (fs)
+    assert np.all(np.diff(trace[:, 0]) > 0)
+
+    again, summary_again = replay(records)  # no wall clock in the loop
+    assert np.array_equal(trace[:, [0, 1, 3, 4]], again[:, [0, 1, 3, 4]])
@@ -0,0 +1,59 @@
+# test_drift_correction_spectrum.py
+# Ring and grid helpers against direct computations, and Welch estimates of known signals.
+from collections import deque
+import numpy as np
+import pytest
+from drift_correction_spectrum import sample_ring, grid_mean, grid_sum, welch, spectrum_worker
+
+
+def test_sample_ring_wrap_around_matches_deque():
+    rng = np.random.default_rng(17)
+    for capacity in (1, 5, 64):
+        ring = sample_ring(capacity, 2)
+        expected = deque(maxlen=capacity)
+        for step in range(300):
+            rows = rng.normal(size=(int(rng.integers(0, 2 * capacity + 2)), 2))  # sometimes over capacity
+            ring.extend(rows)
+            expected.extend(map(tuple, rows))
+            assert len(ring) == len(expected)
+            assert np.array_equal(ring.values().reshape(-1, 2), np.array(expected).reshape(-1, 2))
+        ring.clear()
+        assert len(ring) == 0
+
+
+def test_grid_mean_and_sum():
+    edges = np.arange(6.0)  # bins [0, 1) ... [4, 5)
+    stamps = np.array([-0.5, 0.2, 0.8, 1.5, 4.0, 4.9, 5.0])  # before, bins 0, 0, 1, 4, 4, after
+    values = np.array([100.0, 1.0, 3.0, 4.0, 10.0, 12.0, 100.0])
+    assert np.allclose(grid_mean(stamps, values, edges), [2.0, 4.0, 4.0 + 7 / 3, 4.0 + 14 / 3, 11.0])  # 2, 3 interpolated
+    assert list(grid_sum(stamps, values, edges)) == [4.0, 4.0, 0.0, 0.0, 22.0]
+
+
+def test_welch_white_noise_level_and_sine_power():
+    rng = np.random.default_rng(18)
+    rate, segment, sigma = 10.0, 256, 30.0
+    noise = rng.normal(0.0, sigma, 256 * 200)
+    freq, pxx, pyy, pxy = welch(noise, noise, segment, rate)
+    assert freq[-1] == rate / 2 and len(freq) == segment // 2 + 1
+    assert np.mean(pxx[1:-1]) == pytest.approx(2 * sigma ** 2 / rate, rel=0.03)  # one-sided density
+    assert np.allclose(pxx, pyy) and np.allclose(pxy.real, pxx)
+
+    t = np.arange(256 * 20) / rate
+    sine = 50.0 * np.sin(2 * np.pi * 1.25 * t)  # on a frequency bin
+    freq, pxx, pyy, pxy = welch(sine, 2.0 * sine, segment, rate)
+    assert freq[np.argmax(pxx)] == 1.25
+    assert np.sum(pxx) * (freq[1] - freq[0]) == pytest.approx(50.0 ** 2 / 2, rel=0.01)  # power of the sine
+    assert np.allclose(pyy, 4.0 * pxx) and np.allclose(pxy, 2.0 * pxx)
+
+
+def test_spectrum_worker_open_loop_without_corrections():
+    rng = np.random.default_rng(19)
+    worker = spectrum_worker(publish=None, rate=10.0, segment=64)
+    stamps = np.arange(2000) / 40.0  # 50 s of frames at 40 Hz
+    worker.add_errors(stamps[:100], rng.normal(0.0, 30.0, 100), 0.0)
+    assert worker.analyse() is None  # less than two segments
+    worker.add_errors(stamps[100:], rng.normal(0.0, 30.0, 1900), 0.0)
+    results = worker.analyse()
+    assert len(results['freq']) == 33
+    assert np.allclose(results['suppression'], 1.0)  # no corrections, open and closed loop alike
+    assert np.all(results['correction_psd'] == 0.0)
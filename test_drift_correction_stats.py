@@ -0,0 +1,220 @@
+# test_drift_correction_stats.py
+# Randomised comparisons of the streaming estimators against direct computations.
+import copy
+import math
+from collections import deque
+import numpy as np
+import pytest
+from drift_correction_stats import (ring_buffer, decaying_median, drift_kalman, p2_quantile, hampel_gate,
+                                    allan_deviation, quantile_sketch)
+
+
+def test_ring_buffer_mean_matches_fsum():
+    rng = np.random.default_rng(2)
+    for capacity in (1, 5, 120):
+        buffer = ring_buffer(capacity, resum_interval=1000)
+        expected = deque(maxlen=capacity)
+        for step in range(5000):
+            value = float(rng.normal(1e6, 1e3)) if rng.random() < 0.5 else float(rng.normal(0.0, 1e-3))  # mixed scales
+            buffer.append(value)
+            expected.append(value)
+            if rng.random() < 0.05 and len(buffer) > 1:
+                assert buffer.popleft() == expected.popleft()
+            assert len(buffer) == len(expected)
+            assert list(buffer.values()) == list(expected)
+            assert buffer[-1] == expected[-1] and buffer[0] == expected[0]
+            assert abs(buffer.mean() - math.fsum(expected) / len(expected)) <= 1e-9 * 1e6
+
+
+def test_ring_buffer_resize_keeps_newest():
+    buffer = ring_buffer(10)
+    for value in range(25):  # wrapped around
+        buffer.append(value)
+    buffer.resize(4)
+    assert buffer.capacity == 4 and list(buffer.values()) == [21, 22, 23, 24]
+    assert buffer.mean() == 22.5
+    buffer.resize(8)
+    assert list(buffer.values()) == [21, 22, 23, 24]
+    for value in range(25, 31):
+        buffer.append(value)
+    assert list(buffer.values()) == list(range(23, 31))
+    assert buffer.mean() == math.fsum(range(23, 31)) / 8
+    buffer.clear()
+    assert len(buffer) == 0 and list(buffer.values()) == []
+
+
+def sorted_median(values, decay_factor):
+    """the former mode 3 median: sort (value, weight) pairs, first to reach half the total weight"""
+    weights = [decay_factor ** (len(values) - i - 1) for i in range(len(values))]
+    pairs = sorted(zip(values, weights), key=lambda x: x[0])
+    cumulative = np.cumsum([weight for value, weight in pairs])
+    for (value, weight), cum_weight in zip(pairs, cumulative):
+        if cum_weight >= cumulative[-1] / 2:
+            return value
+
+
+def test_decaying_median_matches_sorted_median():
+    rng = np.random.default_rng(4)
+    for decay_factor in (1.0, 0.999, 0.99, 0.95):  # weights well inside float precision over the window
+        median = decaying_median(decay_factor)
+        window = []
+        for step in range(2000):
+            value = float(rng.normal(0.0, 100.0)) if rng.random() < 0.8 else float(rng.integers(-5, 5))  # with ties
+            median.push(value)
+            window.append(value)
+            while len(window) > 1 + int(rng.integers(0, 200)):  # rolling buffer of varying size
+                median.pop_oldest()
+                window.pop(0)
+            assert median.median() == sorted_median(window, decay_factor)
+
+
+def test_decaying_median_decay_change_and_clear():
+    rng = np.random.default_rng(5)
+    median = decaying_median(0.95)
+    values = rng.normal(0.0, 10.0, 300).tolist()
+    for value in values:
+        median.push(value)
+    median.set_decay_factor(0.8)
+    assert median.median() == sorted_median(values, 0.8)
+    median.clear()
+    assert median.median() is None
+
+
+def test_p2_quantile_exact_for_five_samples():
+    rng = np.random.default_rng(6)
+    for p in (0.1, 0.5, 0.9):
+        estimate = p2_quantile(p)
+        values = rng.normal(0.0, 1.0, 5)
+        for n, value in enumerate(values, start=1):
+            estimate.add(value)
+            assert estimate.value() == sorted(values[:n])[min(int(round(p * (n - 1))), n - 1)]
+
+
+def test_p2_quantile_close_to_sample_quantile():
+    rng = np.random.default_rng(7)
+    for p in (0.05, 0.5, 0.95):
+        for values in (rng.normal(0.0, 30.0, 20000), rng.standard_t(2, 20000), rng.exponential(10.0, 20000)):
+            estimate = p2_quantile(p)
+            for value in values:
+                estimate.add(value)
+            rank = np.mean(values <= estimate.value())  # judged by rank, independent of the scale
+            assert abs(rank - p) < 0.01
+            assert len(estimate) == len(values)
+
+
+def test_hampel_gate_rejects_outliers_and_follows_drift():
+    rng = np.random.default_rng(8)
+    gate = hampel_gate(k=3.0, memory=0.05)
+    inliers = outliers = 0
+    for step in range(20000):
+        centre = 0.01 * step  # slow drift, 200 fs over the run
+        if rng.random() < 0.05:
+            accepted = gate.accept(centre + rng.choice([-1, 1]) * rng.uniform(500.0, 2000.0))
+            outliers += accepted and (step >= 16)  # the warmup samples all pass
+        else:
+            inliers += gate.accept(centre + rng.normal(0.0, 30.0))
+    assert outliers == 0
+    assert inliers > 0.97 * 0.95 * 20000
+    assert abs(gate.median - 200.0) < 10.0
+    assert abs(1.4826 * gate.mad - 30.0) < 5.0
+    gate.shift(-200.0)
+    assert abs(gate.median) < 10.0
+
+
+def test_drift_kalman_without_process_noise_is_least_squares():
+    rng = np.random.default_rng(13)
+    stamps = np.sort(rng.uniform(0.0, 20.0, 500))
+    values = 40.0 - 3.0 * stamps + rng.normal(0.0, 30.0, 500)
+    kalman = drift_kalman(meas_noise=30.0, process_noise=0.0, rate_sigma=1e4)  # practically no rate prior
+    for stamp, value in zip(stamps, values):
+        kalman.update(stamp, value)
+    rate, offset = np.polyfit(stamps - stamps[-1], values, 1)  # the fit, at the last stamp
+    assert abs(kalman.rate - rate) < 1e-3
+    assert abs(kalman.offset - offset) < 1e-2
+    assert kalman.updates == 500
+
+
+def test_drift_kalman_tracks_drift_and_shifts():
+    rng = np.random.default_rng(14)
+    kalman = drift_kalman(meas_noise=30.0, process_noise=1.0)
+    for i in range(120 * 60):  # one minute at 120 Hz, 5 fs/s
+        stamp = i / 120.0
+        kalman.update(stamp, 100.0 + 5.0 * stamp + rng.normal(0.0, 30.0))
+    assert abs(kalman.offset - (100.0 + 5.0 * stamp)) < 10.0
+    assert abs(kalman.rate - 5.0) < 1.0
+    kalman.shift(-400.0)
+    assert abs(kalman.offset - (5.0 * stamp - 300.0)) < 10.0
+    kalman.reset()
+    kalman.update(1.0, 7.0)
+    assert (kalman.offset, kalman.rate) == (7.0, 0.0)
+
+
+def test_drift_kalman_weights_frames_by_quality():
+    kalman = drift_kalman(meas_noise=30.0, process_noise=0.0)
+    for i in range(200):
+        kalman.update(i / 120.0, 0.0, proxy=1.0)
+    good, bad = copy.copy(kalman), copy.copy(kalman)
+    good.update(200 / 120.0, 300.0, proxy=1.0)
+    bad.update(200 / 120.0, 300.0, proxy=10.0)  # a wide or weak edge
+    assert 0.0 < bad.offset < good.offset / 50
+
+
+def test_allan_deviation_matches_block_means():
+    rng = np.random.default_rng(15)
+    values = rng.normal(0.0, 30.0, 3000) + np.cumsum(rng.normal(0.0, 1.0, 3000))
+    allan = allan_deviation(levels=8, memory=1e9)  # running means only
+    for value in values:
+        allan.add(value)
+    assert len(allan) == 3000
+    for level, deviation in enumerate(allan.deviation()):
+        size = 2 ** level
+        means = values[:len(values) // size * size].reshape(-1, size).mean(axis=1)  # non-overlapping blocks
+        assert deviation == pytest.approx(np.sqrt(np.mean(0.5 * np.diff(means) ** 2)), rel=1e-9)
+
+
+def test_allan_deviation_best_size():
+    rng = np.random.default_rng(16)
+    allan = allan_deviation(levels=12, memory=100)
+    for value in rng.normal(0.0, 30.0, 1 << 14):  # white noise: averaging always helps
+        allan.add(value)
+    deviation = allan.deviation()
+    for level in range(6):
+        assert deviation[level] == pytest.approx(30.0 / np.sqrt(2 ** level), rel=0.3)
+    assert np.isnan(deviation[-1])  # too few blocks yet
+    assert allan.best_size() is None
+    allan.clear()
+    assert allan.best_size() is None and len(allan) == 0
+    # white noise of 30 fs on a random walk of 1 fs per sample: minimum near sqrt(3) * 30 samples
+    for value in rng.normal(0.0, 30.0, 1 << 16) + np.cumsum(rng.normal(0.0, 1.0, 1 << 16)):
+        allan.add(value)
+    assert allan.best_size() in (16, 32, 64, 128)
+
+
+def test_quantile_sketch_relative_accuracy():
+    rng = np.random.default_rng(20)
+    values = np.concatenate((rng.normal(0.0, 30.0, 5000), rng.lognormal(3.0, 2.0, 5000), np.zeros(100)))
+    sketch = quantile_sketch(relative_accuracy=0.01)
+    for part in np.array_split(rng.permutation(np.append(values, np.nan)), 7):  # NaN ignored
+        sketch.add(part)
+    assert len(sketch) == len(values)
+    ordered = np.sort(values)
+    for q in np.linspace(0.0, 1.0, 101):
+        exact = ordered[int(q * (len(values) - 1))]
+        assert abs(sketch.quantile(q) - exact) <= 0.01 * abs(exact) + 1e-9
+    assert quantile_sketch().quantile(0.5) is None
+
+
+def test_quantile_sketch_merge_and_remove():
+    rng = np.random.default_rng(21)
+    first, second, total = quantile_sketch(), quantile_sketch(), quantile_sketch()
+    a, b = rng.normal(10.0, 5.0, 1000), rng.normal(-10.0, 5.0, 500)
+    first.add(a)
+    second.add(b)
+    total.merge(first)
+    total.merge(second)
+    both = quantile_sketch()
+    both.add(np.concatenate((a, b)))
+    assert (total.positive, total.negative, total.count) == (both.positive, both.negative, both.count)
+    total.merge(second, -1)  # a sliding window drops a bucket this way
+    assert (total.positive, total.negative, total.zeros, total.count) == \
+        (first.positive, first.negative, first.zeros, first.count)